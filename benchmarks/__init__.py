@@ -0,0 +1,6 @@
+"""
+Benchmarks for the hot paths of the framework.
+
+Each module can be run on its own, eg. python -m webframe.benchmarks.routing
+or through the bench command in webframe.commands.
+"""
@@ -0,0 +1,72 @@
+"""
+Routing benchmark.
+
+Compares the compiled router with a linear scan of the routes list
+(how routes were matched before the router was compiled) for route
+tables of increasing size. Lookups are timed for the first route, the
+last route and a path which does not match any route (a 404).
+"""
+
+import timeit
+from webframe.core.route import Router, split_path, is_param
+
+SIZES = (10, 100, 1000, 10000)
+NUMBER = 2000
+
+
+def make_routes(count):
+    """Make a routes list of roughly half static and half parameterised routes."""
+    routes = []
+    for i in range(count):
+        if i % 2:
+            path = f'/section{i}/item/{{item_id}}/edit'
+        else:
+            path = f'/section{i}/list'
+        routes.append({
+            'path': path,
+            'command': None,
+            'name': f'route{i}',
+            'method': 'GET',
+        })
+    return routes
+
+def linear_match(routes, method, path):
+    """The previous algorithm: check every route in order."""
+    requested = split_path(path)
+    for route_params in routes:
+        if route_params['method'].upper() != method:
+            continue
+        candidate = split_path(route_params['path'])
+        if len(candidate) != len(requested):
+            continue
+        for req, cand in zip(requested, candidate):
+            if not is_param(cand) and req != cand:
+                break
+        else:
+            return route_params
+    return None
+
+def fill(path):
+    return path.replace('{item_id}', '42')
+
+def time_lookup(func):
+    """Average time of one call in microseconds."""
+    return timeit.timeit(func, number=NUMBER) / NUMBER * 1e6
+
+def run():
+    print(f'{"routes":>8} {"lookup":>8} {"linear (us)":>12} {"compiled (us)":>14}')
+    for size in SIZES:
+        routes = make_routes(size)
+        router = Router(routes)
+        paths = {
+            'first': fill(routes[0]['path']),
+            'last': fill(routes[-1]['path']),
+            '404': '/section/does/not/exist',
+        }
+        for label, path in paths.items():
+            linear = time_lookup(lambda: linear_match(routes, 'GET', path))
+            compiled = time_lookup(lambda: router.match('GET', path))
+            print(f'{size:>8} {label:>8} {linear:>12.2f} {compiled:>14.2f}')
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,127 @@
+"""
+Session store benchmark.
+
+Compares the SessionFileStore with the SessionSQLiteStore for what a
+request does with its session: load one, load and commit one (also on a
+new thread, as the server handles each request), create one and destroy
+one. Then times purging expired sessions from a store where a
+tenth of the sessions have expired, and the throughput of loading and
+committing sessions from several processes at once.
+"""
+
+import os
+import shutil
+import timeit
+import secrets
+import datetime
+import tempfile
+import threading
+import multiprocessing
+from webframe.core.http.session import SessionFileStore, SessionSQLiteStore
+
+STORES = (('file', SessionFileStore), ('sqlite', SessionSQLiteStore))
+SESSIONS = 10000
+NUMBER = 2000
+PROCESSES = 4
+
+
+def new_session(expiry):
+    return {'flash': {}, 'csrf': secrets.token_hex(32), 'expiry': expiry, '_auth': 1}
+
+def fill(store_type, session_dir, count, expired=0):
+    """Commit count sessions, the first expired of them have expired, returns their tokens."""
+    now = datetime.datetime.now()
+    tokens = []
+    for i in range(count):
+        token = secrets.token_hex(32)
+        store = store_type(token, session_dir)
+        offset = -3600 if i < expired else 3600
+        store.session = new_session(now + datetime.timedelta(seconds=offset))
+        store.commit()
+        tokens.append(token)
+    return tokens
+
+def time_operation(func):
+    """Average time of one operation in microseconds."""
+    return timeit.timeit(func, number=NUMBER) / NUMBER * 1e6
+
+def operations(store_type, session_dir, tokens):
+    expiry = datetime.datetime.now() + datetime.timedelta(hours=1)
+    counter = iter(range(10 ** 9))
+
+    def token():
+        return tokens[next(counter) % len(tokens)]
+
+    def load():
+        store_type(token(), session_dir)
+
+    def load_commit():
+        store = store_type(token(), session_dir)
+        store.session['expiry'] = expiry
+        store.commit()
+
+    def create_destroy():
+        store = store_type(secrets.token_hex(32), session_dir)
+        store.session = new_session(expiry)
+        store.commit()
+        store.destroy()
+
+    def load_commit_thread():
+        # As the server, which starts a thread for each request.
+        thread = threading.Thread(target=load_commit)
+        thread.start()
+        thread.join()
+
+    return (
+        ('load', load),
+        ('load+commit', load_commit),
+        ('load+commit (new thread)', load_commit_thread),
+        ('create+destroy', create_destroy),
+    )
+
+def worker(store_type, session_dir, tokens, count):
+    expiry = datetime.datetime.now() + datetime.timedelta(hours=1)
+    for i in range(count):
+        store = store_type(tokens[i % len(tokens)], session_dir)
+        store.session['expiry'] = expiry
+        store.commit()
+
+def concurrent(store_type, session_dir, tokens):
+    """Loads and commits a second from PROCESSES processes at once."""
+    count = NUMBER // PROCESSES
+    context = multiprocessing.get_context('fork')
+    processes = [
+        context.Process(target=worker, args=(store_type, session_dir, tokens[i::PROCESSES], count))
+        for i in range(PROCESSES)
+    ]
+
+    def run():
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    return count * PROCESSES / timeit.timeit(run, number=1)
+
+def run():
+    results = {}
+    for name, store_type in STORES:
+        session_dir = tempfile.mkdtemp() + '/'
+        try:
+            tokens = fill(store_type, session_dir, SESSIONS, SESSIONS // 10)
+            for label, func in operations(store_type, session_dir, tokens[SESSIONS // 10:]):
+                results.setdefault(label, {})[name] = time_operation(func)
+            results.setdefault(f'concurrent ({PROCESSES} procs)', {})[name] = concurrent(
+                store_type, session_dir, tokens[SESSIONS // 10:]
+            )
+            purge = timeit.timeit(lambda: store_type.purge_expired(session_dir), number=1)
+            results.setdefault(f'purge {SESSIONS // 10} of {SESSIONS}', {})[name] = purge * 1e6
+        finally:
+            shutil.rmtree(session_dir)
+
+    print(f'{"operation":>26} {"file":>14} {"sqlite":>14}')
+    for label, timings in results.items():
+        unit = 'ops/s' if label.startswith('concurrent') else 'us'
+        print(f'{label:>26} ' + ' '.join(f'{timings[name]:>8.1f} {unit:<5}' for name, _ in STORES))
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,71 @@
+"""
+Static resource benchmark.
+
+Compares the StaticServer with how resources were served before it (a
+check that the file exists and a new webob FileApp for every request)
+for files of increasing size, with and without a matching If-None-Match.
+Each request is a full WSGI call with the body read.
+"""
+
+import os
+import shutil
+import timeit
+import tempfile
+from webob import Request
+from webob.static import FileApp
+from webframe.core.static import StaticServer
+
+SIZES = (1024, 64 * 1024, 1024 * 1024)
+NUMBER = 2000
+
+
+def previous(root, path):
+    """The previous get_resource_response()."""
+    path = root + '/' + path
+    if not os.path.exists(path) or not os.path.isfile(path):
+        raise IOError
+    return FileApp(path)
+
+def call(wsgi_app, environ):
+    """Run a request and read the body, returns the status."""
+    started = []
+    body = wsgi_app(environ, lambda status, headers, exc_info=None: started.append(status))
+    try:
+        for _ in body:
+            pass
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+    return started[0]
+
+def time_request(func):
+    """Average time of one request in microseconds."""
+    return timeit.timeit(func, number=NUMBER) / NUMBER * 1e6
+
+def run():
+    root = tempfile.mkdtemp()
+    try:
+        server = StaticServer(root)
+        print(f'{"size":>9} {"request":>10} {"FileApp (us)":>13} {"static (us)":>12}')
+        for size in SIZES:
+            name = f'file{size}.css'
+            with open(os.path.join(root, name), 'wb') as f:
+                f.write(b'a' * size)
+            request = Request.blank('/' + name)
+            etag = server.response(request, name).headers['ETag']
+            for label, headers in (('full', {}), ('304', {'If-None-Match': etag})):
+                def old():
+                    environ = Request.blank('/' + name, headers=headers).environ
+                    return call(previous(root, name), environ)
+
+                def new():
+                    request = Request.blank('/' + name, headers=headers)
+                    return call(server.response(request, name), request.environ)
+
+                print(f'{size:>9} {label:>10} {time_request(old):>13.2f} {time_request(new):>12.2f}')
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    run()
@@ -13,6 +13,23 @@ test <function_name>
 register-models
     register or re-register all models. This should be run before migrate
     when new models have been added.
+bench <name>
+    run a framework benchmark from webframe.benchmarks (eg. routing).
+serve
+    run the pre-forking production server (see webframe.core.server).
+serve <workers>
+    same as serve with the given number of worker processes.
+profile:report
+    print the slowest functions from the saved request profiles.
+profile:report <route>
+    same as profile:report for one route (its name, see core/profiling).
+assets:build
+    fingerprint, bundle and minify the public resources (see core/assets).
+sessions:gc
+    remove expired sessions through the session store's expiry index.
+sessions:gc full
+    same as sessions:gc but reads every session, eg. those stored before
+    the index existed.
 """
 
 import sys
@@ -20,6 +37,7 @@ import os
 import glob
 import time
 import logging
+import importlib
 import stringcase
 from sqlalchemy import MetaData
 from sqlalchemy_utils.functions import create_database, drop_database, database_exists
@@ -49,6 +67,16 @@ def parse_commands(settings):
         logging.info('Registering models...')
         register_models(settings)
         logging.info('Models registered.')
+    elif arg1 == 'bench':
+        _bench(arg2)
+    elif arg1 == 'serve':
+        _serve(settings, arg2)
+    elif arg1 == 'profile:report':
+        _profile_report(settings, arg2)
+    elif arg1 == 'assets:build':
+        _assets_build(settings)
+    elif arg1 == 'sessions:gc':
+        _sessions_gc(settings, arg2)
     else:
         logging.info('Printing info, someone needs reminding ;)')
         _usage()
@@ -84,6 +112,40 @@ def register_models(settings):
     with open(initfile, 'w') as init:
         init.write(str)
 
+def _serve(settings, workers):
+    from webframe.core.server import PreforkServer
+    # Importing the wsgi module sets up and preloads the app.
+    wsgi = importlib.import_module(settings.APP.__name__ + '.wsgi')
+    application = getattr(wsgi, 'application', None)
+    PreforkServer(
+        wsgi.app,
+        settings,
+        int(workers) if workers else None,
+        application.shutdown if application is not None else None
+    ).run()
+
+def _bench(name):
+    try:
+        benchmark = importlib.import_module('webframe.benchmarks.' + str(name))
+    except ImportError:
+        print(f'No benchmark named: {name}')
+        return
+    benchmark.run()
+
+def _profile_report(settings, route):
+    from webframe.core import profiling
+    profiling.report(os.path.join(settings.STORAGE_DIR, 'profiles'), route)
+
+def _assets_build(settings):
+    from webframe.core import assets
+    manifest = assets.build(settings)
+    print(f'Built {len(manifest)} resources into {os.path.join(settings.RESOURCE_DIR, assets.BUILD_DIR)}.')
+
+def _sessions_gc(settings, arg):
+    from webframe.core.http.session import Session, session_dir
+    purged = Session.purge_expired(session_dir(settings), full=arg == 'full')
+    print(f'Removed {purged} expired sessions.')
+
 def _usage():
     print(__doc__)
 
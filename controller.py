@@ -4,12 +4,16 @@ There will be one controller per page/view.
 Each controller will implement a view method which will be in
 charge of returning a string.
 """
+import copy
+import inspect
 import logging
 from webframe.utils import errors
+from webframe.utils import concurrency
 from webframe.utils import views
 from webframe.utils.auth import auth
 from webframe.forms.form import Form
-from webframe.core import app
+from webframe.core import app, timing
+from webframe.core.http.session import LazyCsrfToken
 
 class Controller(object):
 
@@ -20,6 +24,9 @@ class Controller(object):
     model_id = None
     # defines if the subclass of this controller will handle validation.
     self_validating = False
+    # Answer GET requests with 304 Not Modified before view() runs when the
+    # client's copy is still current, see validators().
+    conditional = False
 
     def __init__(self):
         """Declare class attributes."""
@@ -29,28 +36,111 @@ class Controller(object):
 
     def __call__(self, request, response):
         """Call the controller instance."""
+        # Routes hold a single instance of the controller, so handle each
+        # request on a copy to keep concurrent requests apart.
+        controller = copy.copy(self)
+        if controller.is_async():
+            # Returns a coroutine, to be awaited by the caller.
+            return controller._handle_async(request, response)
+        return controller._handle(request, response)
+
+    def is_async(self):
+        """True if the view is a coroutine (async def view(self))."""
+        return inspect.iscoroutinefunction(self.view)
+
+    def _handle(self, request, response):
+        """Handle the request."""
+        try:
+            return self._dispatch(request, response)
+        finally:
+            self._commit_session()
+
+    async def _handle_async(self, request, response):
+        """Handle the request with an async view."""
+        try:
+            return await self._dispatch_async(request, response)
+        finally:
+            await concurrency.run_sync(self._commit_session)
+
+    def _commit_session(self):
+        """
+        Commit the session if it changed. session_commit only runs once the
+        view has, this saves what was stored before an abort or redirect,
+        eg. the errors flashed by form_invalid().
+        """
+        session = getattr(self.request, 'session', None)
+        if session is not None:
+            session.commit()
+
+    def _dispatch(self, request, response):
+        """Run the model lookup, middleware, form and view."""
         self.request = request
         self.response = response
 
         # Order of operations for controller
-        self.request.model = self._get_model_or_404()
+        with timing.phase('model'):
+            self.request.model = self._get_model_or_404()
 
         # Middleware
-        self.__run_middleware()
+        with timing.phase('middleware'):
+            self.__run_middleware()
 
         # Form handling
-        self.form = self._form_setup()
+        with timing.phase('form'):
+            self.form = self._form_setup()
 
-        if self.form is not None and not self.__class__.self_validating:
-            if not self.form.validate():
-                self.form_invalid()
-            self.form.extract()
+            if self.form is not None and not self.__class__.self_validating:
+                if not self.form.validate():
+                    self.form_invalid()
+                self.form.extract()
 
         # View handling
         try:
-            return self.view()
+            if self._not_modified():
+                return ''
+            with timing.phase('view'):
+                return self.view()
+        finally:
+            with timing.phase('after_middleware'):
+                self._run_middleware_after()
+
+    async def _dispatch_async(self, request, response):
+        """
+        The same order as _dispatch(), blocking steps run in the thread pool.
+        """
+        self.request = request
+        self.response = response
+
+        with timing.phase('model'):
+            self.request.model = await concurrency.run_sync(self._get_model_or_404)
+
+        with timing.phase('middleware'):
+            await self._run_middleware_async(self._middleware_before())
+
+        with timing.phase('form'):
+            self.form = self._form_setup()
+
+            if self.form is not None and not self.__class__.self_validating:
+                if not await concurrency.run_sync(self.form.validate):
+                    await concurrency.run_sync(self.form_invalid)
+                self.form.extract()
+
+        try:
+            if await concurrency.run_sync(self._not_modified):
+                return ''
+            with timing.phase('view'):
+                return await self.view()
         finally:
-            self._run_middleware_after()
+            with timing.phase('after_middleware'):
+                await self._run_middleware_async(self._middleware_after())
+
+    def _middleware_before(self):
+        """Global middleware then route specific middleware."""
+        return app.userapp.settings.GLOBAL_MIDDLEWARE +\
+            self.request.route.middleware
+
+    def _middleware_after(self):
+        return app.userapp.settings.GLOBAL_AFTER_MIDDLEWARE
 
     def __run_middleware(self):
         """
@@ -60,20 +150,24 @@ class Controller(object):
         """
         # To collect: global middleware, route specific middleware.
         # Global middleware takes priority.
-        middleware = app.userapp.settings.GLOBAL_MIDDLEWARE +\
-                    self.request.route.middleware
-
-        for mware in middleware:
-            mware(self.request, self.response)
+        for mware in self._middleware_before():
+            # async def middleware is run to completion.
+            concurrency.resolve(mware(self.request, self.response))
 
     def _run_middleware_after(self):
         """
         Similar to __run_middleware(), except it is just global middleware.
         """
-        middleware = app.userapp.settings.GLOBAL_AFTER_MIDDLEWARE
+        for mware in self._middleware_after():
+            concurrency.resolve(mware(self.request, self.response))
 
+    async def _run_middleware_async(self, middleware):
+        """Await async middleware, run sync middleware in the thread pool."""
         for mware in middleware:
-            mware(self.request, self.response)
+            if concurrency.is_async_callable(mware):
+                await mware(self.request, self.response)
+            else:
+                await concurrency.run_sync(mware, self.request, self.response)
 
     def _get_model_or_404(self):
         """
@@ -96,6 +190,43 @@ class Controller(object):
         return record
 
 
+    def validators(self):
+        """
+        Returns (etag, last_modified) for the page, either may be None.
+        Used when conditional is True. Defaults to the updated_at of the
+        fetched model. Override to include anything else the page depends on.
+        """
+        model = self.request.model
+        updated_at = getattr(model, 'updated_at', None)
+        if updated_at is None:
+            return None, None
+        etag = '%s-%s-%s' % (model.__class__.__name__, model.id, updated_at.timestamp())
+        return etag, updated_at
+
+    def _not_modified(self):
+        """
+        Set the validators on the response. True (and the status set to 304)
+        if the client's copy is current.
+        """
+        if not self.__class__.conditional or self.request.method not in ('GET', 'HEAD'):
+            return False
+        etag, last_modified = self.validators()
+        if etag is not None:
+            # Weak, the page may differ in ways the validator does not cover.
+            self.response.etag = (etag, False)
+        if last_modified is not None:
+            self.response.last_modified = last_modified
+
+        if etag is not None and self.request.if_none_match:
+            not_modified = etag in self.request.if_none_match
+        elif self.response.last_modified is not None and self.request.if_modified_since is not None:
+            not_modified = self.response.last_modified <= self.request.if_modified_since
+        else:
+            not_modified = False
+        if not_modified:
+            self.response.status = 304
+        return not_modified
+
     def _form_setup(self):
         """
         For initialising and setting up a form.
@@ -128,7 +259,8 @@ class Controller(object):
         """Get the default template arguments to be given to every template."""
         # Add arguments from response. (these are often set in middleware).
         arguments = {**self.response.template_args, **arguments}
-        arguments['_token'] = self.request.session.csrf_token()
+        # Only loads the session if the template renders it.
+        arguments['_token'] = LazyCsrfToken(self.request.session)
         arguments['alerts'] = self._get_alerts()
         arguments['errors'] = self._get_errors()
         arguments['old'] = self._get_old_input()
@@ -0,0 +1,309 @@
+"""
+Admission control.
+
+Decides if a request may start being handled. Requests beyond
+MAX_CONNECTIONS wait in a bounded queue for up to QUEUE_TIMEOUT seconds
+and are turned away (503) if the queue is full or the wait times out.
+
+Routes can set:
+    'priority': one of the PRIORITY_* values. Waiting requests in a higher
+        priority lane are always admitted first. PRIORITY_HIGH requests (eg.
+        health checks) have HIGH_PRIORITY_SLOTS slots beyond MAX_CONNECTIONS
+        to themselves and a queue of HIGH_PRIORITY_QUEUE of their own, so
+        they are let through when the server is overloaded.
+    'concurrency': the most requests to the route handled at once, a
+        bulkhead so one slow route cannot use up every slot.
+"""
+
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Slots beyond the limit which only PRIORITY_HIGH requests may use.
+HIGH_PRIORITY_SLOTS = 1
+# Waiting PRIORITY_HIGH requests, on top of the queue for the others.
+HIGH_PRIORITY_QUEUE = 10
+
+
+class Overloaded(Exception):
+    """Raised when a request is not admitted."""
+
+    def __init__(self, reason, retry_after=1):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter(object):
+    """A thread waiting in the queue."""
+
+    __slots__ = ('event', 'admitted')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.admitted = False
+
+    def wake(self):
+        self.event.set()
+
+
+class _AsyncWaiter(object):
+    """An asyncio task waiting in the queue."""
+
+    __slots__ = ('loop', 'future', 'admitted')
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+        self.admitted = False
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self._set)
+
+    def _set(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class Gate(object):
+    """
+    Lets at most limit holders in at once, with a bounded queue of waiters.
+    A released slot is handed straight to the next waiter so a newly arrived
+    request cannot jump the queue. PRIORITY_HIGH holders may also use
+    reserved slots and wait in a queue of up to high_queue of their own.
+    """
+
+    def __init__(self, limit, max_queue=0, lanes=3, reserved=0, high_queue=None):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.reserved = reserved
+        self.high_queue = max_queue if high_queue is None else high_queue
+        self.active = 0
+        self.queued = 0
+        self._lock = threading.Lock()
+        self._lanes = [deque() for _ in range(lanes)]
+
+    def _lane(self, priority):
+        return self._lanes[min(max(priority, 0), len(self._lanes) - 1)]
+
+    def _enter(self, priority, make_waiter):
+        """Returns None if admitted straight away, otherwise a queued waiter."""
+        lane = self._lane(priority)
+        high = lane is self._lanes[0]
+        with self._lock:
+            if high:
+                # Only waits behind other high priority requests.
+                if self.active < self.limit + self.reserved and not lane:
+                    self.active += 1
+                    return None
+                if len(lane) >= self.high_queue:
+                    raise Overloaded('queue full')
+            else:
+                if self.active < self.limit and not self.queued:
+                    self.active += 1
+                    return None
+                if self.queued - len(self._lanes[0]) >= self.max_queue:
+                    raise Overloaded('queue full')
+            waiter = make_waiter()
+            lane.append(waiter)
+            self.queued += 1
+            return waiter
+
+    def _give_up(self, waiter, priority):
+        """Remove a waiter which timed out, True if it was admitted meanwhile."""
+        with self._lock:
+            if waiter.admitted:
+                return True
+            self._lane(priority).remove(waiter)
+            self.queued -= 1
+            return False
+
+    def acquire(self, priority=PRIORITY_NORMAL, timeout=None):
+        """Wait for a slot. Raises Overloaded if none is available in time."""
+        waiter = self._enter(priority, _Waiter)
+        if waiter is None:
+            return
+        waiter.event.wait(timeout)
+        if not self._give_up(waiter, priority):
+            raise Overloaded('timed out')
+
+    async def acquire_async(self, loop, priority=PRIORITY_NORMAL, timeout=None):
+        """As acquire() but waits without blocking the event loop."""
+        waiter = self._enter(priority, lambda: _AsyncWaiter(loop))
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            # Cancelled, hand on the slot if it was given to us meanwhile.
+            if self._give_up(waiter, priority):
+                self.release()
+            raise
+        if not self._give_up(waiter, priority):
+            raise Overloaded('timed out')
+
+    def release(self):
+        """Free a slot, handing it to the highest priority waiter."""
+        with self._lock:
+            for i, lane in enumerate(self._lanes):
+                if lane:
+                    if i and self.active > self.limit:
+                        # A reserved slot, kept for high priority requests.
+                        break
+                    waiter = lane.popleft()
+                    self.queued -= 1
+                    waiter.admitted = True
+                    waiter.wake()
+                    return
+            self.active -= 1
+
+
+class Admission(object):
+    """A granted admission, passed back to AdmissionController.release()."""
+
+    __slots__ = ('bulkhead', 'arrived', 'started')
+
+    def __init__(self, bulkhead, arrived):
+        self.bulkhead = bulkhead
+        self.arrived = arrived
+        self.started = time.monotonic()
+
+
+class AdmissionController(object):
+    """The global gate, a bulkhead gate per limited route and the stats."""
+
+    def __init__(self, max_active, max_queue=0, timeout=None, reserved=0, high_queue=None):
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.high_queue = high_queue
+        self.gate = Gate(max_active, max_queue, reserved=reserved, high_queue=high_queue)
+        self._bulkheads = {}
+        self._lock = threading.Lock()
+
+        self.admitted = 0
+        self.rejected = 0
+        self.queue_time = 0.0
+        self.max_queue_time = 0.0
+        self.service_time = 0.0
+        self.completed = 0
+
+    @staticmethod
+    def from_settings(settings):
+        return AdmissionController(
+            settings.MAX_CONNECTIONS,
+            getattr(settings, 'MAX_QUEUE', 100),
+            getattr(settings, 'QUEUE_TIMEOUT', 10),
+            getattr(settings, 'HIGH_PRIORITY_SLOTS', HIGH_PRIORITY_SLOTS),
+            getattr(settings, 'HIGH_PRIORITY_QUEUE', HIGH_PRIORITY_QUEUE)
+        )
+
+    def _route_limits(self, route):
+        """The priority and bulkhead gate for a route (which may be None)."""
+        params = getattr(route, 'route_params', None)
+        if not params:
+            return PRIORITY_NORMAL, None
+        priority = params.get('priority', PRIORITY_NORMAL)
+        limit = params.get('concurrency')
+        if limit is None:
+            return priority, None
+        key = id(params)
+        try:
+            return priority, self._bulkheads[key]
+        except KeyError:
+            with self._lock:
+                return priority, self._bulkheads.setdefault(
+                    key, Gate(limit, self.max_queue, high_queue=self.high_queue)
+                )
+
+    def _remaining(self, arrived):
+        if self.timeout is None:
+            return None
+        return max(self.timeout - (time.monotonic() - arrived), 0)
+
+    def acquire(self, route=None):
+        """Admit a request to the route. Raises Overloaded if it is turned away."""
+        arrived = time.monotonic()
+        priority, bulkhead = self._route_limits(route)
+        try:
+            if bulkhead is not None:
+                bulkhead.acquire(priority, self.timeout)
+            try:
+                self.gate.acquire(priority, self._remaining(arrived))
+            except Overloaded:
+                if bulkhead is not None:
+                    bulkhead.release()
+                raise
+        except Overloaded as e:
+            self._rejected(route, e)
+            raise
+        return self._admitted(bulkhead, arrived)
+
+    async def acquire_async(self, loop, route=None):
+        """As acquire() but for use from an event loop."""
+        arrived = time.monotonic()
+        priority, bulkhead = self._route_limits(route)
+        try:
+            if bulkhead is not None:
+                await bulkhead.acquire_async(loop, priority, self.timeout)
+            try:
+                await self.gate.acquire_async(loop, priority, self._remaining(arrived))
+            except BaseException:
+                if bulkhead is not None:
+                    bulkhead.release()
+                raise
+        except Overloaded as e:
+            self._rejected(route, e)
+            raise
+        return self._admitted(bulkhead, arrived)
+
+    def release(self, admission):
+        """Finish a request which was admitted."""
+        self.gate.release()
+        if admission.bulkhead is not None:
+            admission.bulkhead.release()
+        service_time = time.monotonic() - admission.started
+        with self._lock:
+            self.completed += 1
+            self.service_time += service_time
+
+    def _admitted(self, bulkhead, arrived):
+        admission = Admission(bulkhead, arrived)
+        queue_time = admission.started - arrived
+        with self._lock:
+            self.admitted += 1
+            self.queue_time += queue_time
+            self.max_queue_time = max(self.max_queue_time, queue_time)
+        return admission
+
+    def _rejected(self, route, e):
+        with self._lock:
+            self.rejected += 1
+        logging.warning(
+            'Request to \'%s\' turned away: %s',
+            getattr(route, 'name', None),
+            e.reason
+        )
+
+    def stats(self):
+        """Current load and totals, times are in seconds."""
+        with self._lock:
+            return {
+                'active': self.gate.active,
+                'queued': self.gate.queued,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'queue_time': self.queue_time,
+                'max_queue_time': self.max_queue_time,
+                'service_time': self.service_time,
+                'mean_queue_time': self.queue_time / self.admitted if self.admitted else 0.0,
+                'mean_service_time': self.service_time / self.completed if self.completed else 0.0,
+            }
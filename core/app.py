@@ -11,5 +11,40 @@ userapp = None
 # The router
 router = None
 
-# The DB session
-db = None
\ No newline at end of file
+# The DB session (a webframe.core.context.ContextSession once set up).
+db = None
+
+# Makes new DB sessions bound to the engine.
+session_factory = None
+
+# The full page cache (a webframe.core.cache.PageCache once set up).
+page_cache = None
+
+# Serves the public resources (a webframe.core.static.StaticServer once set up).
+static = None
+
+# True once the app has been set up and is able to serve requests.
+ready = False
+
+# Callables run once at boot, once at shutdown and in each worker process
+# after it is forked from the master by the pre-fork server.
+# Each is called with the implementing app.
+startup_hooks = []
+shutdown_hooks = []
+after_fork_hooks = []
+
+
+def on_startup(func):
+    """Register a function to be run once the app has been set up."""
+    startup_hooks.append(func)
+    return func
+
+def on_shutdown(func):
+    """Register a function to be run when the app shuts down."""
+    shutdown_hooks.append(func)
+    return func
+
+def on_after_fork(func):
+    """Register a function to be run in each forked worker process."""
+    after_fork_hooks.append(func)
+    return func
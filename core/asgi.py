@@ -0,0 +1,260 @@
+"""
+The ASGI entry point for the app.
+
+Uses the same router, middleware and Request/Response objects as the
+WSGI entry point. Async controllers (async def view()) and async
+middleware run on the event loop, sync controllers are run in the
+loop's thread pool so they never block it.
+"""
+
+import sys
+import time
+import asyncio
+import logging
+from io import BytesIO
+from webob.static import FileApp
+from webframe.core.http.requests import Request
+from webframe.core.http.responses import Response
+from webframe.core.http.files import FileResponse, SendfileResponse
+from webframe.core.http.streaming import StreamingBody
+from webframe.core.route import ResourceRoute
+from webframe.core.wsgi import WSGIApp
+from webframe.core.admission import Overloaded
+from webframe.core import app, context, timing, metrics
+from webframe.utils import errors
+from webframe.utils.concurrency import is_async_callable, run_sync
+
+
+class ASGIApp(WSGIApp):
+    """
+    The app entry point from an asgi call.
+    Like WSGIApp this should be built once at boot.
+    """
+
+    async def __call__(self, scope, receive, send):
+        """The app entry point."""
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type: ' + scope['type'])
+
+        body = await self.read_body(receive)
+        environ = self.make_environ(scope, body)
+
+        if not app.ready:
+            response = Response(Request(environ))
+            response.status = 503
+            response.headers['Retry-After'] = '1'
+            response.content_type = 'text/plain'
+            response.text = 'Service unavailable.'
+            await self.send_response(response, environ, send)
+            return
+
+        ctx = context.RequestContext()
+        timing.start(ctx)
+        with ctx:
+            await self.handle_async(environ, send)
+        timing.collect(ctx)
+
+    async def lifespan(self, receive, send):
+        """Run the startup and shutdown hooks for the server's lifespan events."""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await run_sync(self.startup)
+                except Exception as e:
+                    logging.exception(e)
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await run_sync(self.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle_async(self, environ, send):
+        """Handle a request inside its request context."""
+        logging.info('New request incoming...')
+        started = time.perf_counter()
+        request = Request(environ)
+        ctx = context.current()
+        ctx.request = request
+        if metrics.path is not None and request.path_info == metrics.path:
+            await self.send_response(await run_sync(metrics.response, request), environ, send)
+            return
+        with timing.phase('routing'):
+            route = self.resolve(request)
+
+        cached, flight = None, None
+        if app.page_cache.options(request, route):
+            # May wait for another request rendering the page.
+            cached, flight = await run_sync(app.page_cache.begin, request, route)
+        if cached is not None:
+            await self.send_response(cached, environ, send)
+            self.finished(request, route, cached, started)
+            return
+
+        try:
+            with timing.phase('admission'):
+                admission = await WSGIApp.admission.acquire_async(asyncio.get_event_loop(), route)
+        except Overloaded as e:
+            if flight is not None:
+                app.page_cache.finish(flight)
+            response = self.overloaded(request, e)
+            self.finished(request, route, response, started)
+            await self.send_response(response, environ, send)
+            return
+
+        try:
+            logging.info(
+                'New \'%s\' request for \'%s\' from \'%s\'',
+                request.method,
+                request.path,
+                request.client_addr
+            )
+            try:
+                response = await self.generate_async(request, Response(request), route)
+            except Exception as e:
+                logging.exception(e)
+                response = self.server_error(request)
+            if flight is not None:
+                app.page_cache.finish(flight, response)
+                flight = None
+            timing.set_header(response, ctx.timings)
+            await self.send_response(response, environ, send)
+            self.finished(request, route, response, started)
+        finally:
+            if flight is not None:
+                app.page_cache.finish(flight)
+            WSGIApp.admission.release(admission)
+
+    async def generate_async(self, request, response, route=None):
+        """
+        As WSGIApp.generate(). Only async controllers run on the event loop,
+        anything else is handed to generate() in the thread pool.
+        """
+        if isinstance(route, ResourceRoute) or route is None or not is_async_callable(route.callable):
+            return await run_sync(self.generate, request, response, route)
+
+        try:
+            logging.info('Fetching response...')
+            request.set_route(route)
+            try:
+                rp = await route.callable(request, response)
+                # For file streams.
+                if isinstance(rp, (FileApp, FileResponse, SendfileResponse)):
+                    return rp
+                self.set_body(response, rp)
+                self.add_etag(response, route)
+                logging.info('Response fetched...')
+            except errors.DebugError as e:
+                if app.userapp.settings.DEBUG:
+                    response.status = 500
+                    response.text = e.message
+                else:
+                    raise errors.HttpError(500, '')
+        except errors.HttpError as e:
+            self.set_error(response, e)
+
+        logging.info('Status: %s', response.status)
+
+        return response
+
+    async def read_body(self, receive):
+        """Read the whole request body."""
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        return b''.join(chunks)
+
+    def make_environ(self, scope, body):
+        """Build a WSGI environ from the ASGI scope so webob can be used as is."""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': str(client[0]),
+            'REMOTE_PORT': str(client[1]),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_LENGTH':
+                continue
+            if name == 'CONTENT_TYPE':
+                environ[name] = value
+                continue
+            key = 'HTTP_' + name
+            if key in environ:
+                value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+            environ[key] = value
+        return environ
+
+    async def send_response(self, wsgi_response, environ, send):
+        """
+        Send a Response (or any WSGI app, eg. FileApp) over ASGI.
+        Body chunks which need reading are read in the thread pool.
+        """
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers
+            ]
+
+        iterable = wsgi_response(environ, start_response)
+        is_async = isinstance(iterable, StreamingBody) and iterable.is_async()
+        in_memory = isinstance(iterable, (list, tuple))
+        chunks = iterable if is_async else iter(iterable)
+
+        async def next_chunk():
+            """The next chunk of the body, None once it is finished."""
+            if is_async:
+                try:
+                    return await chunks.__anext__()
+                except StopAsyncIteration:
+                    return None
+            if in_memory:
+                return next(chunks, None)
+            return await run_sync(next, chunks, None)
+
+        try:
+            chunk = await next_chunk()
+            await send({
+                'type': 'http.response.start',
+                'status': started['status'],
+                'headers': started['headers'],
+            })
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await next_chunk()
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if is_async:
+                await iterable.aclose()
+            elif hasattr(iterable, 'close'):
+                iterable.close()
@@ -0,0 +1,330 @@
+"""
+Fingerprinted public resources.
+
+`python project.py assets:build` copies every file in RESOURCE_DIR to
+RESOURCE_DIR/build/ with a hash of its content in the name, eg.
+css/app.css to build/css/app.1b2c3d4e5f60.css, and writes the name of
+each to build/manifest.json. resource('css/app.css') then returns the
+fingerprinted URL, which the static server sends with far future
+'immutable' cache headers since its content can never change.
+
+Settings:
+    ASSET_BUNDLES: files to concatenate into one, eg.
+        {'js/site.js': ['js/vendor.js', 'js/app.js']}
+    ASSET_MINIFY: minify CSS and JS (not *.min.*), True by default.
+    ASSET_GZIP: write a .gz next to text files, True by default.
+
+url() references in CSS are rewritten to the fingerprinted files. Files of
+earlier builds are kept, pages cached by browsers may still use them.
+"""
+
+import os
+import re
+import json
+import gzip
+import hashlib
+import posixpath
+
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+HASH_LENGTH = 12
+# Text files smaller than this are not gzipped.
+GZIP_MIN_SIZE = 500
+GZIP_TYPES = ('.css', '.js', '.svg', '.html', '.txt', '.json', '.xml', '.map')
+
+_FINGERPRINTED = re.compile(r'^/*' + BUILD_DIR + r'/(?:.+/)?[^/]+\.[0-9a-f]{%d}(?:\.[^/.]+)?$' % HASH_LENGTH)
+_CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+# Set by configure().
+manifest_path = None
+reload = False
+
+_manifest = {}
+_manifest_mtime = None
+
+
+def configure(settings):
+    global manifest_path, reload, _manifest_mtime
+    manifest_path = os.path.join(settings.RESOURCE_DIR, BUILD_DIR, MANIFEST)
+    # Pick up rebuilds without a restart while developing.
+    reload = settings.DEBUG
+    _manifest_mtime = None
+    _load()
+
+def _load():
+    global _manifest, _manifest_mtime
+    try:
+        mtime = os.stat(manifest_path).st_mtime_ns
+    except OSError:
+        _manifest, _manifest_mtime = {}, None
+        return
+    if mtime == _manifest_mtime:
+        return
+    with open(manifest_path, encoding='utf-8') as f:
+        _manifest = json.load(f)
+    _manifest_mtime = mtime
+
+def url(path):
+    """The fingerprinted path of a resource path, or the path if it has not been built."""
+    if reload and manifest_path is not None:
+        _load()
+    return _manifest.get(path.lstrip('/'), path)
+
+def is_fingerprinted(path):
+    """True if a resource path is a built file, whose content never changes."""
+    return _FINGERPRINTED.match(path) is not None
+
+
+def build(settings):
+    """Fingerprint RESOURCE_DIR into its build directory, returns the manifest."""
+    root = settings.RESOURCE_DIR
+    build_dir = os.path.join(root, BUILD_DIR)
+    bundles = getattr(settings, 'ASSET_BUNDLES', {})
+    minify = getattr(settings, 'ASSET_MINIFY', True)
+    compress = getattr(settings, 'ASSET_GZIP', True)
+    resource_url = settings.RESOURCE_URL.rstrip('/')
+
+    real_root = os.path.realpath(root)
+    files = []
+    for directory, dirs, names in os.walk(root):
+        if os.path.abspath(directory) == os.path.abspath(root):
+            dirs[:] = [d for d in dirs if d != BUILD_DIR]
+        for name in names:
+            path = os.path.join(directory, name)
+            if name.endswith('.gz') or name.startswith('.'):
+                continue
+            # As the static server, symlinks out of the directory are not published.
+            if os.path.commonpath([real_root, os.path.realpath(path)]) != real_root:
+                continue
+            files.append(os.path.relpath(path, root).replace(os.sep, '/'))
+
+    manifest = {}
+
+    def write(path, data):
+        stem, ext = posixpath.splitext(path)
+        digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+        built = posixpath.join(BUILD_DIR, f'{stem}.{digest}{ext}')
+        target = os.path.join(root, *built.split('/'))
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _write_atomic(target, data)
+            if compress and ext in GZIP_TYPES and len(data) >= GZIP_MIN_SIZE:
+                _write_atomic(target + '.gz', gzip.compress(data, 9, mtime=0))
+        manifest[path] = built
+
+    def read(path):
+        with open(os.path.join(root, *path.split('/')), 'rb') as f:
+            data = f.read()
+        if path.endswith('.css'):
+            # Point url()s at the built files.
+            text = _rewrite_css_urls(data.decode('utf-8'), path, manifest, resource_url)
+            data = text.encode('utf-8')
+        return data
+
+    def minified(path, data):
+        if not minify or '.min.' in posixpath.basename(path):
+            return data
+        if path.endswith('.css'):
+            return minify_css(data.decode('utf-8')).encode('utf-8')
+        if path.endswith('.js'):
+            return minify_js(data.decode('utf-8')).encode('utf-8')
+        return data
+
+    # CSS last, so the files it refers to are in the manifest.
+    files.sort(key=lambda path: (path.endswith('.css'), path))
+    for path in files:
+        write(path, minified(path, read(path)))
+    for bundle, parts in bundles.items():
+        separator = b'\n;\n' if bundle.endswith('.js') else b'\n'
+        data = separator.join(minified(part, read(part)) for part in parts)
+        write(bundle, data)
+
+    os.makedirs(build_dir, exist_ok=True)
+    _write_atomic(
+        os.path.join(build_dir, MANIFEST),
+        json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')
+    )
+    return manifest
+
+def _write_atomic(path, data):
+    temp = f'{path}.{os.getpid()}.tmp'
+    with open(temp, 'wb') as f:
+        f.write(data)
+    os.replace(temp, path)
+
+def _rewrite_css_urls(text, path, manifest, resource_url):
+    def replace(match):
+        ref = match.group(2).strip()
+        if ref.startswith(('data:', '/', '#')) or '://' in ref:
+            return match.group(0)
+        target, suffix = re.match(r'([^?#]*)(.*)', ref).groups()
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(path), target))
+        if target not in manifest:
+            return match.group(0)
+        return f'url({resource_url}/{manifest[target]}{suffix})'
+    return _CSS_URL.sub(replace, text)
+
+
+# Minifying only removes comments and whitespace which can not change
+# the meaning of the code.
+
+def _is_word(c):
+    return c.isalnum() or c in '_$\\' or ord(c) > 127
+
+def _skip_quoted(source, i, quote):
+    """The index after the string starting at i."""
+    i += 1
+    while i < len(source):
+        c = source[i]
+        if c == '\\':
+            i += 2
+            continue
+        i += 1
+        if c == quote:
+            break
+    return i
+
+def _skip_template(source, i):
+    """The index after the JS template literal starting at i."""
+    i += 1
+    while i < len(source):
+        c = source[i]
+        if c == '\\':
+            i += 2
+        elif c == '`':
+            return i + 1
+        elif source.startswith('${', i):
+            i = _skip_braces(source, i + 2)
+        else:
+            i += 1
+    return i
+
+def _skip_braces(source, i):
+    """The index after the } closing a template literal's ${."""
+    depth = 1
+    while i < len(source) and depth:
+        c = source[i]
+        if c in '\'"':
+            i = _skip_quoted(source, i, c)
+            continue
+        if c == '`':
+            i = _skip_template(source, i)
+            continue
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+        i += 1
+    return i
+
+def _skip_regex(source, i):
+    """The index after the JS regex literal starting at i, flags included."""
+    i += 1
+    in_class = False
+    while i < len(source):
+        c = source[i]
+        if c == '\\':
+            i += 2
+            continue
+        i += 1
+        if c == '[':
+            in_class = True
+        elif c == ']':
+            in_class = False
+        elif c == '/' and not in_class:
+            break
+        elif c == '\n':
+            # Not a regex after all.
+            return i
+    while i < len(source) and _is_word(source[i]):
+        i += 1
+    return i
+
+_REGEX_AFTER = set('(,=:[!&|?{};+-*%<>~^')
+_REGEX_KEYWORDS = {
+    'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void',
+    'throw', 'case', 'do', 'else', 'yield', 'await'
+}
+
+def _minify(source, js):
+    out = []
+    last = ''  # The last token written.
+    space = ''  # Whitespace skipped since then: '', ' ' or '\n'.
+    i = 0
+    n = len(source)
+
+    def emit(token):
+        nonlocal last, space
+        if space and out:
+            before, after = last[-1], token[0]
+            if js and space == '\n' and before not in '{};,([=:' and after not in '});,]':
+                # Newlines may end statements.
+                out.append('\n')
+            elif (
+                (_is_word(before) and _is_word(after))
+                or (before in '+-' and after in '+-')
+                or (before == '/' or after == '/')
+                # eg. 1 .toString()
+                or (before.isdigit() and after == '.')
+                or (not js and before not in '{};,:>' and after not in '{};,>')
+            ):
+                out.append(' ')
+        if not js and token == '}' and out and out[-1] == ';':
+            out.pop()
+        out.append(token)
+        last = token
+        space = ''
+
+    while i < n:
+        c = source[i]
+        if c.isspace():
+            j = i
+            while j < n and source[j].isspace():
+                j += 1
+            if js and '\n' in source[i:j]:
+                space = '\n'
+            elif not space:
+                space = ' '
+            i = j
+        elif source.startswith('/*', i):
+            end = source.find('*/', i + 2)
+            end = n if end < 0 else end + 2
+            if source.startswith('/*!', i):
+                # Licences are kept.
+                emit(source[i:end])
+            elif js and '\n' in source[i:end]:
+                space = '\n'
+            elif not space:
+                space = ' '
+            i = end
+        elif js and source.startswith('//', i):
+            end = source.find('\n', i)
+            i = n if end < 0 else end
+        elif c in '\'"':
+            j = _skip_quoted(source, i, c)
+            emit(source[i:j])
+            i = j
+        elif js and c == '`':
+            j = _skip_template(source, i)
+            emit(source[i:j])
+            i = j
+        elif js and c == '/' and (not last or last[-1] in _REGEX_AFTER or last in _REGEX_KEYWORDS):
+            j = _skip_regex(source, i)
+            emit(source[i:j])
+            i = j
+        elif _is_word(c):
+            j = i
+            while j < n and _is_word(source[j]):
+                j += 1
+            emit(source[i:j])
+            i = j
+        else:
+            emit(c)
+            i += 1
+    return ''.join(out)
+
+def minify_css(source):
+    return _minify(source, False)
+
+def minify_js(source):
+    return _minify(source, True)
@@ -0,0 +1,300 @@
+"""
+Full page response cache.
+
+Routes opt in with a 'cache' key:
+    {
+        'path': '/articles/{article_id:int}',
+        'command': ArticleController(),
+        'cache': {
+            'ttl': 60,          # Seconds a page is fresh.
+            'stale': 300,       # Seconds an expired page may still be served
+                                # while one request renders a new one.
+            'vary': ['Accept-Language', 'cookie:theme'],
+            'models': [Article],  # Saving or deleting one clears the pages.
+        },
+    }
+
+GET and HEAD requests which hit the cache are answered before admission,
+middleware, the controller and templates run. Pages are keyed on the
+host, path, query string and the 'vary' headers and cookies. Only 200
+responses without 'Cache-Control: private' or 'no-store' are kept, and
+Set-Cookie headers are never stored. Pages rendered with the visitor's
+session (eg. a CSRF token, flashed messages or the logged in user) or for
+a request with a session cookie are not kept, unless the route varies on
+'cookie:session'.
+
+Concurrent misses for the same page wait for the first request to render
+it (single flight). Pages are cleared across worker processes when a
+model listed in 'models' is saved or deleted.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from webob.static import FileApp
+from webframe.core.http.responses import Response
+from webframe.core.http.files import SendfileResponse
+
+MAX_ENTRIES = 1000
+MAX_BYTES = 64 * 1024 * 1024
+# Seconds a request waits for another request rendering the same page.
+WAIT_TIMEOUT = 10
+
+# Never stored with a page.
+_PRIVATE_HEADERS = ('set-cookie', 'server-timing')
+
+
+class _Entry(object):
+
+    __slots__ = ('status', 'headers', 'body', 'created', 'expires', 'stale_until', 'tags', 'size')
+
+    def __init__(self, status, headers, body, ttl, stale, tags):
+        now = time.monotonic()
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.created = now
+        self.expires = now + ttl
+        self.stale_until = self.expires + stale
+        # {tag: version} when the page was rendered.
+        self.tags = tags
+        self.size = len(body) + sum(len(k) + len(v) for k, v in headers)
+
+
+class _Flight(object):
+    """A page being rendered by one request, which others may wait for."""
+
+    __slots__ = ('request', 'key', 'options', 'tags', 'event')
+
+    def __init__(self, request, key, options, tags):
+        self.request = request
+        self.key = key
+        self.options = options
+        self.tags = tags
+        self.event = threading.Event()
+
+
+class PageCache(object):
+    """A byte and entry bounded LRU of rendered pages."""
+
+    def __init__(self, tags_dir=None, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, cached_models=()):
+        self.tags_dir = tags_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        # Models which some route's pages depend on.
+        self.cached_models = set(cached_models)
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_settings(settings, routes):
+        cached_models = set()
+        for route in routes:
+            for model in route.get('cache', {}).get('models', []):
+                cached_models.add(_tag(model))
+        return PageCache(
+            os.path.join(settings.STORAGE_DIR, 'cache', 'tags'),
+            getattr(settings, 'PAGE_CACHE_ENTRIES', MAX_ENTRIES),
+            getattr(settings, 'PAGE_CACHE_BYTES', MAX_BYTES),
+            cached_models
+        )
+
+    def options(self, request, route):
+        """The route's cache options if the request may be cached, otherwise None."""
+        params = getattr(route, 'route_params', None)
+        if not params or request.method not in ('GET', 'HEAD'):
+            return None
+        return params.get('cache')
+
+    def _key(self, request, options):
+        key = [request.host, request.path, request.query_string]
+        for vary in options.get('vary', ()):
+            if vary.startswith('cookie:'):
+                key.append(request.cookies.get(vary[7:]))
+            else:
+                key.append(request.headers.get(vary))
+        return tuple(key)
+
+    def begin(self, request, route):
+        """
+        Returns (cached response, None) for a hit. On a miss returns
+        (None, flight) if this request should render the page and pass the
+        flight to finish(), or (None, None) if the page is not cached.
+        """
+        options = self.options(request, route)
+        if not options:
+            return None, None
+        key = self._key(request, options)
+
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None and not self._current(entry):
+                self._remove(key, entry)
+                entry = None
+
+            now = time.monotonic()
+            with self._lock:
+                if entry is not None and now < entry.expires:
+                    self._entries.move_to_end(key)
+                    return self._response(request, entry, 'HIT'), None
+                flight = self._flights.get(key)
+                if entry is not None and now < entry.stale_until:
+                    if flight is not None:
+                        # Another request is rendering a new one.
+                        return self._response(request, entry, 'STALE'), None
+                if flight is None:
+                    flight = self._flights[key] = _Flight(request, key, options, self._versions(options))
+                    return None, flight
+
+            if not flight.event.wait(WAIT_TIMEOUT):
+                return None, None
+            with self._lock:
+                if key not in self._entries:
+                    # Not cacheable, render it without the cache.
+                    return None, None
+
+    def finish(self, flight, response=None):
+        """Store the page rendered for a flight, None if rendering failed."""
+        try:
+            entry = self._entry(flight, response)
+            if entry is not None:
+                self._store(flight.key, entry)
+        except Exception as e:
+            logging.warning('Unable to cache page.')
+            logging.exception(e)
+        finally:
+            with self._lock:
+                self._flights.pop(flight.key, None)
+            flight.event.set()
+
+    def _entry(self, flight, response):
+        if response is None or response.__class__ == FileApp or response.status_code != 200:
+            return None
+        if isinstance(response, SendfileResponse):
+            # Its signed location expires.
+            return None
+        if not isinstance(response.app_iter, list):
+            # Streamed and file bodies are not kept.
+            return None
+        cache_control = response.headers.get('Cache-Control', '').lower()
+        if 'private' in cache_control or 'no-store' in cache_control:
+            return None
+        if not _shared(flight.request, flight.options):
+            return None
+        headers = [(k, v) for k, v in response.headerlist if k.lower() not in _PRIVATE_HEADERS]
+        return _Entry(
+            response.status,
+            headers,
+            response.body,
+            flight.options.get('ttl', 60),
+            flight.options.get('stale', 0),
+            flight.tags
+        )
+
+    def _response(self, request, entry, state):
+        response = Response(request)
+        response.status = entry.status
+        response.headerlist = list(entry.headers)
+        response.body = entry.body
+        response.headers['Age'] = str(int(time.monotonic() - entry.created))
+        response.headers['X-Cache'] = state
+        # Answer If-None-Match and If-Modified-Since from the cached validators.
+        response.conditional_response = True
+        return response
+
+    def _store(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self._entries[key] = entry
+            self.size += entry.size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def _remove(self, key, entry):
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+                self.size -= entry.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _tag_path(self, tag):
+        return os.path.join(self.tags_dir, tag)
+
+    def _version(self, tag):
+        """Changes each time the tag is invalidated, in any process."""
+        if self.tags_dir is None:
+            return 0
+        try:
+            return os.stat(self._tag_path(tag)).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def _versions(self, options):
+        return {_tag(m): self._version(_tag(m)) for m in options.get('models', ())}
+
+    def _current(self, entry):
+        return all(self._version(tag) == version for tag, version in entry.tags.items())
+
+    def invalidate_model(self, model):
+        """Clear the pages which depend on a model (class or instance)."""
+        tag = _tag(model)
+        if tag not in self.cached_models:
+            return
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if tag in entry.tags:
+                    del self._entries[key]
+                    self.size -= entry.size
+        if self.tags_dir is None:
+            return
+        # Tells the other processes their pages are out of date.
+        try:
+            os.makedirs(self.tags_dir, exist_ok=True)
+            path = self._tag_path(tag)
+            with open(path, 'a'):
+                pass
+            now = time.time_ns()
+            os.utime(path, ns=(now, now))
+        except OSError as e:
+            logging.warning('Unable to invalidate cached pages for %s.', tag)
+            logging.exception(e)
+
+    def invalidate_path(self, path):
+        """Clear every cached page for a path."""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if key[1] == path:
+                    del self._entries[key]
+                    self.size -= entry.size
+
+
+def _shared(request, options):
+    """False if the page may hold the visitor's session, so must not be served to others."""
+    if 'cookie:session' in options.get('vary', ()):
+        return True
+    session = getattr(request, 'session', None)
+    # A Session rather than a LazySession has been loaded.
+    if session is not None and getattr(session, 'loaded', True):
+        return False
+    return 'session' not in request.cookies
+
+def _tag(model):
+    if isinstance(model, str):
+        return model
+    if not isinstance(model, type):
+        model = type(model)
+    return model.__name__
@@ -0,0 +1,84 @@
+"""
+Request scoped state.
+
+Every request is handled inside a RequestContext which holds the
+request, the authorised user, a DB session and the phase timings. The context is kept in a
+ContextVar, so each thread or asyncio task sees only its own request.
+Copies of the context (eg. when work is handed to a thread pool) share
+the same RequestContext object, so a DB session opened there is still
+closed at the end of the request.
+"""
+
+import time
+import threading
+from contextvars import ContextVar
+from webframe.core import app
+
+_current = ContextVar('webframe_request_context', default=None)
+
+# Used outside of a request, eg. by commands, seeders and unit tests.
+_fallback = threading.local()
+
+
+class RequestContext(object):
+    """The state of one request."""
+
+    def __init__(self, request=None):
+        self.request = request
+        self.user = None
+        self._db = None
+        self._token = None
+        # A list of (phase, seconds) while timing is enabled, see core/timing.py.
+        self.timings = None
+        # Set while the response body is streamed, the request is finished
+        # once the body has been sent (see core/http/streaming.py).
+        self.streaming = False
+
+    @property
+    def db(self):
+        """The DB session, taken from the engine pool on first use."""
+        if self._db is None:
+            self._db = app.session_factory()
+        return self._db
+
+    def close_db(self):
+        """Close the DB session if one was opened."""
+        if self._db is not None:
+            start = time.perf_counter()
+            self._db.close()
+            self._db = None
+            if self.timings is not None:
+                self.timings.append(('db_close', time.perf_counter() - start))
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if not self.streaming:
+                self.close_db()
+        finally:
+            _current.reset(self._token)
+            self._token = None
+
+
+def current():
+    """The context of the current request, or of the thread outside of a request."""
+    ctx = _current.get()
+    if ctx is None:
+        try:
+            ctx = _fallback.context
+        except AttributeError:
+            ctx = _fallback.context = RequestContext()
+    return ctx
+
+
+class ContextSession(object):
+    """
+    Stands in for a SQLAlchemy session (as app.db).
+    Every attribute is looked up on the DB session of the current context.
+    """
+
+    def __getattr__(self, name):
+        return getattr(current().db, name)
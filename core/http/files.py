@@ -0,0 +1,197 @@
+"""
+File response bodies.
+
+Whole files are handed to the server's wsgi.file_wrapper, which the built
+in server (core/server.py) sends with sendfile() so the bytes never pass
+through Python. Byte ranges, and servers without a file_wrapper, get a
+FileWrapper over just the range, which is sent with sendfile() by the
+built in server and otherwise read through a memory map in chunks.
+
+Files must not be truncated while they are being sent.
+
+With SENDFILE_BACKEND set, files are not sent by the app at all. The
+response only names the file in an X-Accel-Redirect (nginx) or X-Sendfile
+(apache) header and the front proxy sends it:
+    SENDFILE_BACKEND: 'nginx' or 'apache', None sends files from the app.
+    SENDFILE_ROOT: only files below this directory are offloaded, it must
+        be set for either backend.
+    SENDFILE_URL: the nginx internal location which serves SENDFILE_ROOT.
+    SENDFILE_SECRET: signs the nginx URIs with an expiry (secure_link).
+    SENDFILE_EXPIRES: seconds a signed URI is valid for.
+"""
+
+import io
+import os
+import mmap
+import time
+import base64
+import hashlib
+import logging
+import mimetypes
+from urllib.parse import quote
+from webframe.core.http.responses import Response
+
+BLOCK_SIZE = 64 * 1024
+
+SENDFILE_HEADERS = {'nginx': 'X-Accel-Redirect', 'apache': 'X-Sendfile'}
+
+# Set from settings by configure().
+sendfile_backend = None
+sendfile_root = None
+sendfile_url = '/protected'
+sendfile_secret = None
+sendfile_expires = 3600
+
+
+def configure(settings):
+    global sendfile_backend, sendfile_root, sendfile_url, sendfile_secret, sendfile_expires
+    sendfile_backend = getattr(settings, 'SENDFILE_BACKEND', None)
+    if sendfile_backend is not None and sendfile_backend not in SENDFILE_HEADERS:
+        raise ValueError(f'Unknown SENDFILE_BACKEND {sendfile_backend!r}, use one of {list(SENDFILE_HEADERS)}.')
+    sendfile_root = getattr(settings, 'SENDFILE_ROOT', None)
+    if sendfile_root is not None:
+        sendfile_root = os.path.realpath(sendfile_root)
+    elif sendfile_backend is not None:
+        logging.warning('SENDFILE_BACKEND is set without a SENDFILE_ROOT, no files will be offloaded.')
+    sendfile_url = getattr(settings, 'SENDFILE_URL', '/protected').rstrip('/')
+    sendfile_secret = getattr(settings, 'SENDFILE_SECRET', None)
+    sendfile_expires = getattr(settings, 'SENDFILE_EXPIRES', 3600)
+
+
+class FileWrapper(object):
+    """Iterates over length bytes of a file from offset."""
+
+    def __init__(self, file, block_size=BLOCK_SIZE, offset=0, length=None):
+        self.file = file
+        self.block_size = block_size
+        self.offset = offset
+        if length is None:
+            length = os.fstat(file.fileno()).st_size - offset
+        self.length = max(length, 0)
+
+    def sendable(self):
+        """True if the file can be given to sendfile()."""
+        try:
+            self.file.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return False
+        return True
+
+    def app_iter_range(self, start, stop):
+        """Used by webob to answer Range requests."""
+        return FileWrapper(self.file, self.block_size, self.offset + start, stop - start)
+
+    def __iter__(self):
+        if not self.length:
+            return
+        try:
+            mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            yield from self._read()
+            return
+        with mapped:
+            position = self.offset
+            end = min(self.offset + self.length, len(mapped))
+            while position < end:
+                chunk = mapped[position:min(position + self.block_size, end)]
+                position += len(chunk)
+                yield chunk
+
+    def _read(self):
+        self.file.seek(self.offset)
+        remaining = self.length
+        while remaining > 0:
+            chunk = self.file.read(min(self.block_size, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+def file_iter(request, file):
+    """
+    The app_iter for an open file: the server's wsgi.file_wrapper for a
+    whole file, otherwise a FileWrapper (which can answer a Range request).
+    """
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None and not request.range:
+        return file_wrapper(file, BLOCK_SIZE)
+    return FileWrapper(file)
+
+
+class FileResponse(Response):
+    """
+    A response with a file as its body, with validators and Range support.
+    Raises OSError if the file cannot be opened.
+    """
+
+    def __init__(self, request, path, content_type=None, headerlist=None):
+        Response.__init__(self, request)
+        file = open(path, 'rb')
+        try:
+            st = os.fstat(file.fileno())
+            guessed, encoding = mimetypes.guess_type(path)
+            self.content_type = content_type or guessed or 'application/octet-stream'
+            self.content_encoding = encoding
+            self.app_iter = file_iter(request, file)
+        except BaseException:
+            file.close()
+            raise
+        self.content_length = st.st_size
+        self.last_modified = st.st_mtime
+        self.etag = '%x-%x' % (st.st_mtime_ns, st.st_size)
+        self.accept_ranges = 'bytes'
+        for name, value in headerlist or ():
+            self.headers.add(name, value)
+        self.conditional_response = True
+
+
+class SendfileResponse(Response):
+    """An empty response asking the front proxy to send a file, see offload()."""
+
+
+def sign(uri, expires=None):
+    """
+    Quote an internal URI and add the md5 and expires arguments checked by
+    nginx's secure_link module, configured as:
+        secure_link $arg_md5,$arg_expires;
+        secure_link_md5 "$secure_link_expires$uri <SENDFILE_SECRET>";
+    """
+    expires = int(time.time()) + (sendfile_expires if expires is None else expires)
+    digest = hashlib.md5(f'{expires}{uri} {sendfile_secret}'.encode('utf-8')).digest()
+    token = base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+    return f'{quote(uri)}?md5={token}&expires={expires}'
+
+def offload(request, path, headerlist=None):
+    """
+    A SendfileResponse for a file if SENDFILE_BACKEND is set and the file
+    is below SENDFILE_ROOT, otherwise None and the app sends the file.
+    """
+    if sendfile_backend is None:
+        return None
+    real = os.path.realpath(path)
+    if sendfile_root is None or os.path.commonpath([sendfile_root, real]) != sendfile_root:
+        return None
+    if not os.path.isfile(real):
+        return None
+
+    if sendfile_backend == 'nginx':
+        uri = sendfile_url + '/' + os.path.relpath(real, sendfile_root).replace(os.sep, '/')
+        location = sign(uri) if sendfile_secret else quote(uri)
+    else:
+        # mod_xsendfile unescapes it (XSendFileUnescape).
+        location = quote(real)
+
+    headers = list(headerlist or ())
+    if not any(name.lower() == 'content-type' for name, _ in headers):
+        content_type, encoding = mimetypes.guess_type(real)
+        headers.insert(0, ('Content-Type', content_type or 'application/octet-stream'))
+        if encoding is not None:
+            headers.append(('Content-Encoding', encoding))
+    headers.append((SENDFILE_HEADERS[sendfile_backend], location))
+    response = SendfileResponse(request)
+    response.headerlist = headers
+    return response
@@ -1,9 +1,8 @@
 """Wrapper class for webob response to add functionality in future."""
 
 import webob
-from webob.static import FileApp
 import json
-from webframe.utils.errors import HttpError
+from webframe.utils.errors import HttpError, abort
 
 
 class Response(webob.Response):
@@ -18,7 +17,10 @@ class Response(webob.Response):
         self.status = 302
         self.location = location
         # so the flash data doesn't get wasted on the redirect
-        self.request.session.store('dont_clear_flash', True)
+        # (an unused session has not cleared its flash)
+        session = self.request.session
+        if session is not None and getattr(session, 'loaded', True):
+            session.store('dont_clear_flash', True)
 
         return 'Redirecting...'
 
@@ -45,19 +47,26 @@ class Response(webob.Response):
 
     def download(self, filename, downloadname, download=True):
         """
-        Returns a download stream.
+        Returns a download stream (a FileResponse, see core/http/files.py),
+        or hands the file to the front proxy if SENDFILE_BACKEND is set.
         filename is location of file.
         downloadname is name to download with.
         download (default True): specify whether to download the file or display 
             it inline (aka: content disposition: attachement or inline)
         """
+        from webframe.core.http import files
         disposition = 'attachment'
         if not download:
             disposition = 'inline'
 
-        return FileApp(filename, headerlist=[
-            ['Content-Disposition', f'{disposition}; filename="{downloadname}"']
-        ])
+        headerlist = [('Content-Disposition', f'{disposition}; filename="{downloadname}"')]
+        offloaded = files.offload(self.request, filename, headerlist)
+        if offloaded is not None:
+            return offloaded
+        try:
+            return files.FileResponse(self.request, filename, headerlist=headerlist)
+        except OSError:
+            abort(404)
 
     def read_json(self):
         """Return json data written to this response."""
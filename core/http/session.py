@@ -1,14 +1,106 @@
-"""Session handler for the framework."""
+"""
+Session handler for the framework.
+
+A session is read from its store once per request and kept in memory.
+Changes are written back once, by commit() at the end of the request, and
+only if something changed. Values changed in place (eg. a list from get())
+must be store()d again to be saved. The expiry is only pushed back once it
+has moved by SESSION_EXPIRY_REFRESH seconds, so requests which only read
+the session do not write it.
+
+Sessions are kept in a file per session (SessionFileStore, the default),
+in a SQLite database shared by every process (SessionSQLiteStore), in a
+signed cookie (SessionCookieStore) or in memory for tests
+(SessionMemoryStore), set with Session.StoreType.
+
+Stores index sessions by expiry so expired sessions are purged without
+reading every session: a background thread in each process purges them
+every SESSION_GC_INTERVAL seconds (0 disables it, leaving it to
+`python project.py sessions:gc`).
+"""
 import os
+import re
+import hmac
+import zlib
+import heapq
+import base64
+import hashlib
+import binascii
+import random
 import logging
 import datetime
 from base64 import b64encode
 import time
 import secrets
 import json
+import sqlite3
 import threading
 
-from webframe.core import app
+from webframe.core import app, metrics
+
+# Seconds between purges of expired sessions.
+GC_INTERVAL = 300
+# Seconds the expiry must move by before it is written.
+EXPIRY_REFRESH = 60
+# Sessions are indexed in buckets of expiry times this many seconds wide.
+EXPIRY_BUCKET = 300
+# The file store's index, in the sessions directory.
+EXPIRY_DIR = 'expiry'
+# The SQLite store's database, in the sessions directory.
+SQLITE_FILE = 'sessions.sqlite3'
+# Seconds a SQLite store waits for another writer.
+SQLITE_TIMEOUT = 5
+# Idle SQLite connections kept by each process.
+SQLITE_POOL_SIZE = 8
+
+# Browsers keep cookies of up to 4096 bytes, attributes included.
+COOKIE_MAX_SIZE = 3800
+# Smaller cookie sessions are not compressed.
+COOKIE_COMPRESS_MIN_SIZE = 128
+# Starts the cookie of a session too large for the cookie store.
+SERVER_PREFIX = 'srv.'
+# Shorter session secret keys are refused.
+SECRET_KEY_MIN_LENGTH = 32
+
+_TOKEN = re.compile(r'[0-9a-f]{64}')
+
+# Set from settings by configure().
+secret_keys = []
+cookie_max_size = COOKIE_MAX_SIZE
+cookie_compress = True
+
+
+def configure(settings):
+    global secret_keys, cookie_max_size, cookie_compress
+    keys = []
+    for key in getattr(settings, 'SESSION_SECRET_KEYS', None) or []:
+        key = key.encode('utf-8') if isinstance(key, str) else key
+        # Eg. an empty session_secret_keys= in settings.conf.
+        if not key.strip():
+            continue
+        if len(key) < SECRET_KEY_MIN_LENGTH:
+            raise ValueError(f'SESSION_SECRET_KEYS must be at least {SECRET_KEY_MIN_LENGTH} bytes long.')
+        keys.append(key)
+    if not keys and issubclass(Session.StoreType, SessionCookieStore):
+        raise ValueError('SESSION_SECRET_KEYS must be set to use the SessionCookieStore.')
+    secret_keys = keys
+    cookie_max_size = getattr(settings, 'SESSION_COOKIE_MAX_SIZE', COOKIE_MAX_SIZE)
+    cookie_compress = getattr(settings, 'SESSION_COOKIE_COMPRESS', True)
+
+
+def session_dir(settings):
+    """The directory sessions are kept in."""
+    return settings.STORAGE_DIR + '/sessions/'
+
+def _expiry_bucket(session):
+    expiry = session.get('expiry') if isinstance(session, dict) else None
+    if not isinstance(expiry, datetime.datetime):
+        return None
+    return int(expiry.timestamp()) // EXPIRY_BUCKET
+
+def _expired(session, now):
+    expiry = session.get('expiry') if isinstance(session, dict) else None
+    return not isinstance(expiry, datetime.datetime) or expiry < now
 
 # XXX Race condition if with two requests to same session at once.
 class SessionFileStore:
@@ -27,6 +119,8 @@ class SessionFileStore:
 
         self._create_session_dir_if_not_exists()
         self.session = self._load_session()
+        # The index bucket the token is in.
+        self._indexed = _expiry_bucket(self.session)
 
     def _create_session_dir_if_not_exists(self):
         """Create the session directory if it does not exist."""
@@ -37,10 +131,14 @@ class SessionFileStore:
         """Load the entire session and decode to dict."""
         sess = {}
 
+        metrics.record_session('file', 'read')
         self.lock.acquire()
         try:
             with open(self.session_dir + self.token, 'r') as f:
                 sess = json.loads(f.read(), object_hook=self.from_json_converter)
+        except FileNotFoundError:
+            # A new session.
+            pass
         except (IOError, json.decoder.JSONDecodeError) as e:
             logging.warning('Unable to load session.')
             logging.exception(e)
@@ -56,10 +154,12 @@ class SessionFileStore:
 
     def commit(self):
         """Commit the current session to the store."""
+        metrics.record_session('file', 'write')
         self.lock.acquire()
         try:
             with open(self.session_dir + self.token, 'w') as f:
                 f.write(json.dumps(self.session, default=self.to_json_converter))
+            self._index()
             return True
         except IOError as e:
             logging.warning('Unable to commit sessions.')
@@ -68,6 +168,31 @@ class SessionFileStore:
         finally:
             self.lock.release()
 
+    def _index(self):
+        """Move the token to the index bucket of its expiry if that has changed."""
+        bucket = _expiry_bucket(self.session)
+        if bucket == self._indexed:
+            return
+        if bucket is not None:
+            bucket_dir = os.path.join(self.session_dir, EXPIRY_DIR, str(bucket))
+            os.makedirs(bucket_dir, exist_ok=True)
+            open(os.path.join(bucket_dir, self.token), 'a').close()
+        self._unindex(self.token, self._indexed)
+        self._indexed = bucket
+
+    def _unindex(self, token, bucket):
+        if bucket is None:
+            return
+        try:
+            os.remove(os.path.join(self.session_dir, EXPIRY_DIR, str(bucket), token))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def valid_token(token):
+        """Tokens name files, so only those the session makes are accepted."""
+        return _TOKEN.fullmatch(token) is not None
+
     def to_json_converter(self, obj):
         """Converts non native json types to json from python objects."""
         if isinstance(obj, datetime.datetime):
@@ -87,30 +212,82 @@ class SessionFileStore:
     def set_new_token(self, token):
         """Sets new token, deletes old token."""
         # Delete old session file.
+        metrics.record_session('file', 'delete')
         self.lock.acquire()
         try:
             os.remove(self.session_dir + self.token)
+        except FileNotFoundError:
+            # A new session.
+            pass
         except IOError as e:
             logging.warning('Unable to remove old session.')
             logging.exception(e)
             pass
         finally:
             self.lock.release()
+        self._unindex(self.token, self._indexed)
+        self._indexed = None
 
-        # Set new session file.
+        # The new session file is written by the next commit().
         self.token = token
-        self.commit()
 
     def destroy(self):
         """Destroy the session."""
+        metrics.record_session('file', 'delete')
         os.remove(os.path.join(self.session_dir, self.token))
+        self._unindex(self.token, self._indexed)
+
+    @staticmethod
+    def purge_expired(session_dir, now=None):
+        """
+        Remove the sessions in the index buckets which have passed.
+        Returns the number removed.
+        """
+        now = now or datetime.datetime.now()
+        current = int(now.timestamp()) // EXPIRY_BUCKET
+        index_dir = os.path.join(session_dir, EXPIRY_DIR)
+        try:
+            buckets = os.listdir(index_dir)
+        except FileNotFoundError:
+            return 0
+        purged = 0
+        for bucket in buckets:
+            if not bucket.isdigit() or int(bucket) >= current:
+                continue
+            bucket_dir = os.path.join(index_dir, bucket)
+            try:
+                tokens = os.listdir(bucket_dir)
+            except FileNotFoundError:
+                # Purged by another process.
+                continue
+            for token in tokens:
+                path = os.path.join(session_dir, token)
+                if os.path.exists(path):
+                    store = SessionFileStore(token, session_dir)
+                    # The expiry may have moved on since it was indexed here.
+                    if _expired(store.session, now):
+                        try:
+                            store.destroy()
+                            purged += 1
+                        except FileNotFoundError:
+                            pass
+                try:
+                    os.remove(os.path.join(bucket_dir, token))
+                except FileNotFoundError:
+                    pass
+            try:
+                os.rmdir(bucket_dir)
+            except OSError:
+                pass
+        return purged
 
     @staticmethod
     def all_session_tokens(session_dir):
         """Get all the current session tokens."""
+        metrics.record_session('file', 'list')
         session_files = [
             f for f in os.listdir(session_dir)
-            if os.path.isfile(os.path.join(session_dir, f))
+            if SessionFileStore.valid_token(f) and os.path.isfile(os.path.join(session_dir, f))
         ]
         return session_files
 
@@ -118,18 +295,25 @@ class SessionMemoryStore:
     """Interface for interacting with session store in memory."""
 
     sessions = {}
+    # A heap of (expiry, token), entries for sessions since given a later
+    # expiry are skipped by purge_expired().
+    expiries = []
+    _lock = threading.Lock()
 
     def __init__(self, token, session_dir):
         """Load the session."""
         # Lock for this token.
         self.token = token
+        metrics.record_session('memory', 'read')
         try:
             self.session = SessionMemoryStore.sessions[self.token]
         except KeyError:
             self.session = {}
+        self._indexed = _expiry_bucket(self.session)
 
     def fresh(self):
         """Get latest session data."""
+        metrics.record_session('memory', 'read')
         try:
             self.session = SessionMemoryStore.sessions[self.token]
         except KeyError:
@@ -137,7 +321,13 @@ class SessionMemoryStore:
 
     def commit(self):
         """Commit the current session to the store."""
+        metrics.record_session('memory', 'write')
         SessionMemoryStore.sessions[self.token] = self.session
+        bucket = _expiry_bucket(self.session)
+        if bucket != self._indexed and bucket is not None:
+            with SessionMemoryStore._lock:
+                heapq.heappush(SessionMemoryStore.expiries, (self.session['expiry'], self.token))
+        self._indexed = bucket
 
     def exists(self):
         """True if session file exists."""
@@ -157,16 +347,399 @@ class SessionMemoryStore:
             pass
         SessionMemoryStore.sessions[token] = old
         self.token = token
+        self._indexed = None
     
     def destroy(self):
         """Destroy the session."""
         del SessionMemoryStore.sessions[self.token]
 
+    @staticmethod
+    def valid_token(token):
+        return _TOKEN.fullmatch(token) is not None
+
+    @staticmethod
+    def purge_expired(session_dir, now=None):
+        """Remove the sessions which have expired, returns the number removed."""
+        now = now or datetime.datetime.now()
+        purged = 0
+        with SessionMemoryStore._lock:
+            expiries = SessionMemoryStore.expiries
+            while expiries and expiries[0][0] < now:
+                _, token = heapq.heappop(expiries)
+                session = SessionMemoryStore.sessions.get(token)
+                if session is not None and _expired(session, now):
+                    del SessionMemoryStore.sessions[token]
+                    purged += 1
+        return purged
+
     @staticmethod
     def all_session_tokens(session_dir):
         """Get all the current session tokens."""
         return [k for k in SessionMemoryStore.sessions.keys()]
 
+class SessionSQLiteStore:
+    """
+    Interface for interacting with session store in a SQLite database,
+    shared by every thread and process. Each write is a single atomic
+    statement, the expiry column is indexed for purge_expired().
+    Connections are pooled per process, since the server may start a
+    thread for every request.
+    """
+
+    # Idle connections of this process, by sessions directory.
+    _pool = {}
+    _pool_pid = None
+    _pool_lock = threading.Lock()
+    # The directories whose schema this process has created.
+    _schemas = set()
+    _schema_lock = threading.Lock()
+
+    def __init__(self, token, session_dir):
+        """Load the session."""
+        self.token = token
+        self.session_dir = session_dir
+        self.session = self._load_session()
+
+    @staticmethod
+    def _connect(session_dir):
+        """Take an idle connection of this process, or open one."""
+        cls = SessionSQLiteStore
+        with cls._pool_lock:
+            if cls._pool_pid != os.getpid():
+                # Connections must not be used across a fork.
+                cls._pool_pid = os.getpid()
+                cls._pool = {}
+                cls._schemas = set()
+            idle = cls._pool.setdefault(session_dir, [])
+            if idle:
+                return idle.pop()
+        os.makedirs(session_dir, exist_ok=True)
+        # Used by one thread at a time, but not always the one which opened it.
+        connection = sqlite3.connect(
+            os.path.join(session_dir, SQLITE_FILE),
+            timeout=SQLITE_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        try:
+            connection.execute('PRAGMA synchronous=NORMAL')
+            with cls._schema_lock:
+                if session_dir not in cls._schemas:
+                    # Readers do not wait for writers in WAL mode (kept by the database).
+                    connection.execute('PRAGMA journal_mode=WAL')
+                    connection.execute(
+                        'CREATE TABLE IF NOT EXISTS sessions ('
+                        'token TEXT PRIMARY KEY, data TEXT NOT NULL, expiry REAL NOT NULL)'
+                    )
+                    connection.execute('CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expiry)')
+                    cls._schemas.add(session_dir)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    @staticmethod
+    def _release(session_dir, connection):
+        """Put a connection back in the pool, or close it if the pool is full."""
+        cls = SessionSQLiteStore
+        with cls._pool_lock:
+            idle = cls._pool.get(session_dir)
+            if cls._pool_pid == os.getpid() and idle is not None and len(idle) < SQLITE_POOL_SIZE:
+                idle.append(connection)
+                return
+        connection.close()
+
+    @staticmethod
+    def execute(session_dir, sql, parameters=()):
+        """Run a statement on a pooled connection, returns (rows, rowcount)."""
+        connection = SessionSQLiteStore._connect(session_dir)
+        try:
+            cursor = connection.execute(sql, parameters)
+            rows = cursor.fetchall()
+            rowcount = cursor.rowcount
+        except sqlite3.OperationalError:
+            # Eg. the database was removed, create the schema again.
+            with SessionSQLiteStore._schema_lock:
+                SessionSQLiteStore._schemas.discard(session_dir)
+            connection.close()
+            raise
+        except BaseException:
+            connection.close()
+            raise
+        SessionSQLiteStore._release(session_dir, connection)
+        return rows, rowcount
+
+    def _load_session(self):
+        """Load the entire session and decode to dict."""
+        metrics.record_session('sqlite', 'read')
+        self._stored = False
+        try:
+            rows, _ = self.execute(
+                self.session_dir, 'SELECT data FROM sessions WHERE token = ?', (self.token,)
+            )
+            if not rows:
+                # A new session.
+                return {}
+            self._stored = True
+            return json.loads(rows[0][0], object_hook=self.from_json_converter)
+        except (sqlite3.Error, json.decoder.JSONDecodeError) as e:
+            logging.warning('Unable to load session.')
+            logging.exception(e)
+            return {}
+
+    def fresh(self):
+        """Get fresh data from the database."""
+        self.session = self._load_session()
+
+    def commit(self):
+        """Commit the current session to the store."""
+        metrics.record_session('sqlite', 'write')
+        expiry = self.session.get('expiry')
+        # Sessions without an expiry are purged as expired.
+        expiry = expiry.timestamp() if isinstance(expiry, datetime.datetime) else 0
+        try:
+            self.execute(
+                self.session_dir,
+                'INSERT INTO sessions (token, data, expiry) VALUES (?, ?, ?) '
+                'ON CONFLICT (token) DO UPDATE SET data = excluded.data, expiry = excluded.expiry',
+                (self.token, json.dumps(self.session, default=self.to_json_converter), expiry)
+            )
+            self._stored = True
+            return True
+        except sqlite3.Error as e:
+            logging.warning('Unable to commit sessions.')
+            logging.exception(e)
+            return False
+
+    valid_token = staticmethod(SessionFileStore.valid_token)
+    to_json_converter = SessionFileStore.to_json_converter
+    from_json_converter = SessionFileStore.from_json_converter
+
+    def exists(self):
+        """True if the session was in the database when it was loaded."""
+        return self._stored
+
+    def set_new_token(self, token):
+        """Sets new token, deletes old token."""
+        if self._stored:
+            self._delete()
+        # The new session is written by the next commit().
+        self.token = token
+
+    def destroy(self):
+        """Destroy the session."""
+        self._delete()
+
+    def _delete(self):
+        metrics.record_session('sqlite', 'delete')
+        try:
+            self.execute(self.session_dir, 'DELETE FROM sessions WHERE token = ?', (self.token,))
+        except sqlite3.Error as e:
+            logging.warning('Unable to remove old session.')
+            logging.exception(e)
+        self._stored = False
+
+    @staticmethod
+    def purge_expired(session_dir, now=None):
+        """Remove the sessions which have expired, returns the number removed."""
+        now = now or datetime.datetime.now()
+        _, purged = SessionSQLiteStore.execute(
+            session_dir, 'DELETE FROM sessions WHERE expiry < ?', (now.timestamp(),)
+        )
+        return purged
+
+    @staticmethod
+    def all_session_tokens(session_dir):
+        """Get all the current session tokens."""
+        metrics.record_session('sqlite', 'list')
+        rows, _ = SessionSQLiteStore.execute(session_dir, 'SELECT token FROM sessions')
+        return [row[0] for row in rows]
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def _mac(key, value):
+    return hmac.new(key, value.encode('ascii'), hashlib.sha256).digest()
+
+def _sign(payload):
+    """A cookie value holding a payload, signed with the first of the secret keys."""
+    if not secret_keys:
+        raise ValueError('SESSION_SECRET_KEYS must be set to use the SessionCookieStore.')
+    data = payload.encode('utf-8')
+    kind = 'j'
+    if cookie_compress and len(data) >= COOKIE_COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(data, 9)
+        if len(compressed) < len(data):
+            data, kind = compressed, 'z'
+    value = kind + '.' + _b64encode(data)
+    return value + '.' + _b64encode(_mac(secret_keys[0], value))
+
+def _unsign(value):
+    """The payload of a cookie value, None unless one of the secret keys signed it."""
+    parts = value.split('.')
+    if not secret_keys or len(parts) != 3 or parts[0] not in ('j', 'z'):
+        return None
+    signed = parts[0] + '.' + parts[1]
+    try:
+        signature = _b64decode(parts[2])
+        # Older keys are accepted so keys can be rotated.
+        if not any(hmac.compare_digest(_mac(key, signed), signature) for key in secret_keys):
+            return None
+        data = _b64decode(parts[1])
+        if parts[0] == 'z':
+            data = zlib.decompress(data)
+        return data.decode('utf-8')
+    except (ValueError, binascii.Error, zlib.error):
+        return None
+
+class SessionCookieStore:
+    """
+    Interface for keeping the session in its cookie, so loading and
+    committing it does no I/O. The cookie is signed (HMAC-SHA256) with the
+    first of SESSION_SECRET_KEYS, any of them is accepted. A session too
+    large for the cookie is kept in the FallbackType store and the cookie
+    only holds its token.
+    Note: the token (the cookie) changes on every commit, and the cookie
+    of a destroyed session stays valid until it expires.
+    """
+
+    FallbackType = SessionFileStore
+
+    def __init__(self, token, session_dir):
+        """Load the session."""
+        self.token = token
+        self.session_dir = session_dir
+        # The fallback store, if the session is kept in one.
+        self._server = None
+        self.session = self._load_session()
+
+    def _load_session(self):
+        """Decode the session from the token."""
+        self._stored = False
+        if self.token.startswith(SERVER_PREFIX):
+            self._server = self.FallbackType(self.token[len(SERVER_PREFIX):], self.session_dir)
+            self._stored = self._server.exists()
+            return self._server.session
+        payload = _unsign(self.token)
+        if payload is None:
+            # A new session.
+            return {}
+        try:
+            session = json.loads(payload, object_hook=self.from_json_converter)
+        except ValueError as e:
+            logging.warning('Unable to load session.')
+            logging.exception(e)
+            return {}
+        if _expired(session, datetime.datetime.now()):
+            # The cookie outlived the session.
+            return {}
+        self._stored = True
+        return session
+
+    def fresh(self):
+        """Decode the session from the token again."""
+        self.session = self._load_session()
+
+    def commit(self):
+        """Sign the session into a new token, or commit it to the fallback store if it is too large."""
+        value = _sign(json.dumps(self.session, default=self.to_json_converter, separators=(',', ':')))
+        if len(value) <= cookie_max_size:
+            # It may fit again.
+            self._drop_server()
+            self.token = value
+        else:
+            if self._server is None:
+                self._server = self.FallbackType(secrets.token_hex(32), self.session_dir)
+            self._server.session = self.session
+            if not self._server.commit():
+                return False
+            self.token = SERVER_PREFIX + self._server.token
+        self._stored = True
+        return True
+
+    to_json_converter = SessionFileStore.to_json_converter
+    from_json_converter = SessionFileStore.from_json_converter
+
+    @staticmethod
+    def valid_token(token):
+        """A signed session, or the token of one in the fallback store."""
+        if token.startswith(SERVER_PREFIX):
+            return SessionCookieStore.FallbackType.valid_token(token[len(SERVER_PREFIX):])
+        return _unsign(token) is not None
+
+    def exists(self):
+        """True if the token held a current session."""
+        return self._stored
+
+    def set_new_token(self, token):
+        """Sets new token, deletes the old session if it was in the fallback store."""
+        self._drop_server()
+        self._stored = False
+        self.token = token
+
+    def destroy(self):
+        """Destroy the session."""
+        self._drop_server()
+        self._stored = False
+
+    def _drop_server(self):
+        """Delete the session from the fallback store."""
+        if self._server is None:
+            return
+        if self._server.exists():
+            try:
+                self._server.destroy()
+            except (OSError, KeyError):
+                pass
+        self._server = None
+
+    @staticmethod
+    def purge_expired(session_dir, now=None):
+        """Remove the expired sessions of the fallback store, returns the number removed."""
+        return SessionCookieStore.FallbackType.purge_expired(session_dir, now)
+
+    @staticmethod
+    def all_session_tokens(session_dir):
+        """Get the tokens of the sessions in the fallback store."""
+        return [
+            SERVER_PREFIX + token
+            for token in SessionCookieStore.FallbackType.all_session_tokens(session_dir)
+        ]
+
+_janitor_pid = None
+_janitor_lock = threading.Lock()
+
+def start_janitor(session_dir, interval=GC_INTERVAL):
+    """Purge expired sessions every interval seconds on a thread, once per process."""
+    global _janitor_pid
+    if not interval or _janitor_pid == os.getpid():
+        return
+    with _janitor_lock:
+        # Threads do not survive a fork, each worker starts its own.
+        if _janitor_pid == os.getpid():
+            return
+        _janitor_pid = os.getpid()
+    threading.Thread(
+        target=_janitor_loop,
+        args=(session_dir, interval),
+        name='webframe-session-janitor',
+        daemon=True
+    ).start()
+
+def _janitor_loop(session_dir, interval):
+    while True:
+        # Jittered so workers do not all purge at once.
+        time.sleep(interval * random.uniform(0.5, 1.5))
+        try:
+            Session.purge_expired(session_dir)
+        except Exception as e:
+            logging.warning('Unable to purge expired sessions.')
+            logging.exception(e)
+
+
 # 32 characters should be enough.
 TOKEN_LENGTH = 32
 class Session(object):
@@ -178,12 +751,15 @@ class Session(object):
 
     def __init__(self, request):
         """Initialise session for this user."""
-        session_dir = app.userapp.settings.STORAGE_DIR + '/sessions/'
-
-        self._purge_expired_sessions(session_dir)
+        settings = app.userapp.settings
+        directory = session_dir(settings)
+        start_janitor(directory, getattr(settings, 'SESSION_GC_INTERVAL', GC_INTERVAL))
 
         self.request = request
-        self.session_expiry = app.userapp.settings.SESSION_EXPIRY
+        self.session_expiry = settings.SESSION_EXPIRY
+        self.expiry_refresh = getattr(settings, 'SESSION_EXPIRY_REFRESH', EXPIRY_REFRESH)
+        # True once the session differs from the stored one.
+        self._dirty = False
         try:
             # Check is Cookie actually exists
             self.request.headers['Cookie']
@@ -193,26 +769,33 @@ class Session(object):
             cookies = self.request.cookies
         try:
             self.token = cookies['session']
+            if not Session.StoreType.valid_token(self.token):
+                raise KeyError
         except KeyError:
             self.token = self._generate_new_session_token()
 
-        self._store = Session.StoreType(self.token, session_dir)
+        self._store = Session.StoreType(self.token, directory)
         self._create_if_not_exists()
         self._clear_flash()
         self._update_expiry()
-        self.commit()
 
-    def _purge_expired_sessions(self, session_dir):
-        """Remove expired sessions."""
-        tokens = Session.StoreType.all_session_tokens(session_dir)
-        for token in tokens:
+    @staticmethod
+    def purge_expired(session_dir, full=False):
+        """
+        Remove expired sessions from the store, returns the number removed.
+        Only the store's expiry index is checked unless full is True, which
+        reads every session (eg. those stored before the index).
+        """
+        if not full:
+            return Session.StoreType.purge_expired(session_dir)
+        now = datetime.datetime.now()
+        purged = 0
+        for token in Session.StoreType.all_session_tokens(session_dir):
             store = Session.StoreType(token, session_dir)
-            try:
-                expiry = store.session['expiry']
-                if expiry < datetime.datetime.now():
-                    raise KeyError
-            except KeyError:
+            if _expired(store.session, now):
                 store.destroy()
+                purged += 1
+        return purged
 
     def _generate_new_session_token(self, length=TOKEN_LENGTH):
         """Returns a new session token."""
@@ -220,10 +803,12 @@ class Session(object):
 
     def _create_if_not_exists(self):
         """Try to get or create then return a session with the current token."""
-        if not self._store.exists():
+        # An expired session not purged yet is as good as gone.
+        if not self._store.exists() or _expired(self._store.session, datetime.datetime.now()):
             self._set_fresh_session()
             self.token = self._generate_new_session_token()
             self._store.set_new_token(self.token)
+            self._dirty = True
 
     def _get_new_session_expiry_from_now(self):
         expiry = datetime.datetime.now() + datetime.timedelta(days=365)
@@ -239,23 +824,25 @@ class Session(object):
         }
 
     def _clear_flash(self):
-        try:
-            self._store.session['dont_clear_flash']
-        except KeyError:
+        if 'dont_clear_flash' in self._store.session:
+            self.delete('dont_clear_flash')
+        elif self._store.session.get('flash') != {}:
             self._store.session['flash'] = {}
-
-        self.delete('dont_clear_flash')
+            self._dirty = True
     
     def _update_expiry(self):
-        """Updates expiry for this request."""
-        try:
-            self._store.session['expiry'] = self._get_new_session_expiry_from_now()
-        except KeyError:
-            pass
+        """Push the expiry back if it has moved by expiry_refresh seconds."""
+        expiry = self._store.session.get('expiry')
+        new_expiry = self._get_new_session_expiry_from_now()
+        if (
+            not isinstance(expiry, datetime.datetime)
+            or (new_expiry - expiry).total_seconds() >= self.expiry_refresh
+        ):
+            self._store.session['expiry'] = new_expiry
+            self._dirty = True
 
     def get(self, key):
         """Get a value from the current session."""
-        self._store.fresh()
         try:
             return self._store.session[key]
         except KeyError:
@@ -263,27 +850,29 @@ class Session(object):
 
     def store(self, key, value):
         """Store a value in the session."""
+        # Always written, the value may be one from get() changed in place.
         self._store.session[key] = value
-        self.commit()
+        self._dirty = True
 
     def delete(self, key):
         """Delete a value from the session. Fails silently."""
         try:
             del self._store.session[key]
+            self._dirty = True
         except KeyError:
             pass
-        self.commit()
     
     def destroy(self):
         """Destroy the session completely."""
         self._set_fresh_session()
         self.token = self._generate_new_session_token()
         self._store.set_new_token(self.token)
+        self._dirty = True
 
     def flash(self, key, value):
         """Store a value for one request/response cycle."""
         self._store.session['flash'][key] = value
-        self.commit()
+        self._dirty = True
 
     def get_flash(self, key):
         """Get specific key from flash."""
@@ -294,7 +883,6 @@ class Session(object):
 
     def flash_data(self):
         """Get values only available for one request/response cycle."""
-        self._store.fresh()
         return self._store.session['flash']
 
     def csrf_token(self):
@@ -302,7 +890,6 @@ class Session(object):
         Generates or gets/stores the CSRF token.
         Returns the CSRF token for the session.
         """
-        self._store.fresh()
         token = None
         try:
             token = self._store.session['csrf']
@@ -310,8 +897,7 @@ class Session(object):
                 raise KeyError
         except KeyError:
             token = str(secrets.token_hex(32))
-            self._store.session['csrf'] = token
-            self.commit()
+            self.store('csrf', token)
         return token
 
     def check_csrf(self, tokenToCheck):
@@ -325,15 +911,120 @@ class Session(object):
             return False
 
     def set_response_session_token(self, response, path="/", max_age=3600):
+        """Set the session cookie, unless the request already has it."""
+        if self.request.cookies.get('session') == self.token:
+            return
+        response.unset_cookie('session', strict=False)
         response.set_cookie('session', self.token)
 
     def commit(self):
         """
-        Commit the current session data.
+        Commit the current session data if it has changed.
         This is a wrapper method around the commit method of the 
         chosen session store.
         """
+        if not self._dirty:
+            return
         self._store.commit()
+        # The cookie store's token changes with the session.
+        self.token = self._store.token
+        self._dirty = False
 
     def __repr__(self):
-        return str(self._store.session)
\ No newline at end of file
+        return str(self._store.session)
+
+
+class LazySession(object):
+    """
+    Stands in for the request's Session, which is only loaded (and its
+    cookie set) when it is first used. Reads on a request without a
+    session cookie are answered without creating a session.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self._session = None
+        self._response = None
+
+    @property
+    def loaded(self):
+        """True once the session has been used."""
+        return self._session is not None
+
+    def _load(self):
+        if self._session is None:
+            self._session = Session(self.request)
+            if self._response is not None:
+                self._session.set_response_session_token(self._response)
+        return self._session
+
+    def _absent(self):
+        """True if there is no session to read from."""
+        if self._session is not None:
+            return False
+        token = self.request.cookies.get('session')
+        return token is None or not Session.StoreType.valid_token(token)
+
+    def get(self, key):
+        if self._absent():
+            return None
+        return self._load().get(key)
+
+    def get_flash(self, key):
+        if self._absent():
+            return None
+        return self._load().get_flash(key)
+
+    def flash_data(self):
+        if self._absent():
+            return {}
+        return self._load().flash_data()
+
+    def check_csrf(self, tokenToCheck):
+        if self._absent():
+            return False
+        return self._load().check_csrf(tokenToCheck)
+
+    def set_response_session_token(self, response, path="/", max_age=3600):
+        """The cookie is set on this response once the session is used."""
+        self._response = response
+        if self._session is not None:
+            self._session.set_response_session_token(response, path, max_age)
+
+    def commit(self):
+        """Commit the session if it was used."""
+        if self._session is None:
+            return
+        self._session.commit()
+        if self._response is not None:
+            # destroy() gives the session a new token.
+            self._session.set_response_session_token(self._response)
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        if self._session is None:
+            return '<LazySession (not loaded)>'
+        return repr(self._session)
+
+
+class LazyCsrfToken(object):
+    """
+    The session's CSRF token for templates. The session is only loaded
+    if the token is rendered.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def __str__(self):
+        return self.session.csrf_token()
+
+    __html__ = __str__
+
+    def __eq__(self, other):
+        return str(self) == other
+
+    def __hash__(self):
+        return hash(str(self))
@@ -0,0 +1,89 @@
+"""
+Streamed response bodies.
+
+A controller may return an iterator or generator of str or bytes chunks
+instead of a string. The chunks are sent as they are produced (chunked
+transfer encoding, there is no Content-Length). The request's context,
+DB session and admission slot are kept until the server closes the body.
+Under ASGI controllers may also return async generators.
+"""
+
+import inspect
+from collections.abc import Iterator
+
+
+def is_stream(rp):
+    """True if a controller's result should be streamed."""
+    return isinstance(rp, Iterator) or inspect.isasyncgen(rp)
+
+
+class StreamingBody(object):
+    """The app_iter of a streamed response, str chunks are encoded."""
+
+    def __init__(self, chunks, charset='utf-8'):
+        self.chunks = chunks
+        self.charset = charset or 'utf-8'
+
+    def _encode(self, chunk):
+        if isinstance(chunk, str):
+            return chunk.encode(self.charset)
+        return chunk
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._encode(next(self.chunks))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return self._encode(await self.chunks.__anext__())
+
+    def is_async(self):
+        return inspect.isasyncgen(self.chunks)
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close is not None and not self.is_async():
+            close()
+
+    async def aclose(self):
+        aclose = getattr(self.chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+class ContextIterable(object):
+    """
+    Wraps the WSGI iterable of a streamed response. Chunks are produced in
+    the request's (contextvars) context and on_close() is called once the
+    server has closed the iterable.
+    """
+
+    def __init__(self, iterable, context, on_close):
+        self.iterable = iterable
+        self.context = context
+        self.on_close = on_close
+        self._iterator = None
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            self._iterator = self.context.run(iter, self.iterable)
+        return self.context.run(next, self._iterator)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self.iterable, 'close', None)
+            if close is not None:
+                self.context.run(close)
+        finally:
+            self.context.run(self.on_close)
@@ -0,0 +1,302 @@
+"""
+Non blocking logging.
+
+setup() sends the root logger's records to a bounded queue. A background
+thread takes them off the queue in batches and writes them to
+STORAGE_DIR/logs/main.log, so a slow log disk never holds up a request.
+If the queue is full records are dropped (and counted) rather than
+waiting for the disk.
+
+Log files are rotated once they pass LOG_MAX_BYTES, rotated files are
+gzipped on another thread and only the last LOG_BACKUPS are kept.
+
+Requests are logged to access.log in the common log format when
+ACCESS_LOG is True. LOG_SAMPLING keeps a fraction of the application's
+records of busy levels, eg. {'DEBUG': 0.01, 'INFO': 0.1}. Every request
+is still written to access.log.
+"""
+
+import os
+import glob
+import gzip
+import time
+import queue
+import random
+import shutil
+import logging
+import threading
+
+FORMAT = '%(asctime)s %(levelname)s: %(message)s'
+DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+MAX_BYTES = 50 * 1024 * 1024
+BACKUPS = 10
+
+access_logger = logging.getLogger('webframe.access')
+access_logger.propagate = False
+
+_handler = None
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the records of each level, eg. {'DEBUG': 0.1}.
+    Access log records are always kept.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = {logging.getLevelName(k) if isinstance(k, str) else k: v for k, v in rates.items()}
+
+    def filter(self, record):
+        if record.name == access_logger.name:
+            return True
+        rate = self.rates.get(record.levelno)
+        return rate is None or random.random() < rate
+
+
+class LogFile(object):
+    """A log file which rotates itself once it passes max_bytes."""
+
+    def __init__(self, path, max_bytes=MAX_BYTES, backups=BACKUPS, compressor=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compressor = compressor
+        self._file = None
+        self._rotations = 0
+
+    def _open(self):
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _reopen_if_moved(self):
+        """Another process may have rotated the file."""
+        try:
+            moved = os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            moved = True
+        if moved:
+            self._file.close()
+            self._open()
+
+    def write(self, text):
+        if self._file is None:
+            self._open()
+        else:
+            self._reopen_if_moved()
+        self._file.write(text)
+        self._file.flush()
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self._file.close()
+        self._file = None
+        self._rotations += 1
+        rotated = f'{self.path}.{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{self._rotations:04d}'
+        try:
+            os.rename(self.path, rotated)
+        except FileNotFoundError:
+            # Rotated by another process.
+            return
+        if self.compressor is not None:
+            self.compressor.put((rotated, self.path, self.backups))
+        else:
+            _prune(self.path, self.backups)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _prune(path, backups):
+    """Remove all but the newest rotated files."""
+    rotated = sorted(glob.glob(glob.escape(path) + '.*'))
+    for old in rotated[:max(len(rotated) - backups, 0)]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+
+def _compress(rotated, path, backups):
+    with open(rotated, 'rb') as src, gzip.open(rotated + '.gz', 'wb') as dest:
+        shutil.copyfileobj(src, dest)
+    os.remove(rotated)
+    _prune(path, backups)
+
+
+class QueueLogHandler(logging.Handler):
+    """
+    Puts records on a queue for the writer thread. Records are dropped when
+    the queue is full.
+    """
+
+    def __init__(self, directory, max_bytes=MAX_BYTES, backups=BACKUPS, queue_size=QUEUE_SIZE):
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self.access_formatter = logging.Formatter('%(message)s')
+        self._start()
+
+    def _start(self):
+        self.queue = queue.Queue(self.queue_size)
+        self.compress_queue = queue.Queue()
+        self.files = {
+            'main': LogFile(os.path.join(self.directory, 'main.log'), self.max_bytes, self.backups, self.compress_queue),
+            'access': LogFile(os.path.join(self.directory, 'access.log'), self.max_bytes, self.backups, self.compress_queue),
+        }
+        self.writer = threading.Thread(target=self._write_loop, name='webframe-log-writer', daemon=True)
+        self.compressor = threading.Thread(target=self._compress_loop, name='webframe-log-compressor', daemon=True)
+        self.writer.start()
+        self.compressor.start()
+
+    def after_fork(self):
+        """Threads do not survive a fork, the child starts its own."""
+        for log_file in self.files.values():
+            log_file.close()
+        self._start()
+
+    def emit(self, record):
+        try:
+            # Formatted now, the args may not be safe to use on another thread.
+            if record.name == access_logger.name:
+                entry = ('access', self.access_formatter.format(record))
+            else:
+                entry = ('main', self.format(record))
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self._drop(1)
+        except Exception:
+            self.handleError(record)
+
+    def _drop(self, count):
+        # Emitted from many request threads at once.
+        with self._dropped_lock:
+            self.dropped += count
+
+    def _write_loop(self):
+        while True:
+            entry = self.queue.get()
+            batch = [entry]
+            # Write whatever else is waiting in one go.
+            while entry is not None and len(batch) < BATCH_SIZE:
+                try:
+                    entry = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(entry)
+            stop = batch[-1] is None
+            self._write([e for e in batch if e is not None])
+            if stop:
+                return
+
+    def _write(self, batch):
+        texts = {'main': [], 'access': []}
+        with self._dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            texts['main'].append(f'{dropped} log records dropped, the log queue was full.')
+        for name, text in batch:
+            texts[name].append(text)
+        for name, lines in texts.items():
+            if not lines:
+                continue
+            try:
+                self.files[name].write('\n'.join(lines) + '\n')
+            except OSError:
+                # Reported as dropped with the next batch.
+                self._drop(len(lines))
+
+    def _compress_loop(self):
+        while True:
+            job = self.compress_queue.get()
+            if job is None:
+                return
+            try:
+                _compress(*job)
+            except OSError:
+                pass
+
+    def flush(self):
+        """Wait (for up to 5 seconds) for the writer to take the queued records."""
+        deadline = time.monotonic() + 5
+        while self.writer.is_alive() and not self.queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        """Write the queued records and stop the threads."""
+        if self.writer.is_alive():
+            try:
+                self.queue.put(None, timeout=5)
+            except queue.Full:
+                pass
+            self.writer.join(5)
+        if self.compressor.is_alive():
+            self.compress_queue.put(None)
+            self.compressor.join(30)
+        for log_file in self.files.values():
+            log_file.close()
+        super().close()
+
+
+def setup(settings):
+    """Log to STORAGE_DIR/logs through the queue, replaces any other root handlers."""
+    global _handler
+    directory = os.path.join(settings.STORAGE_DIR, 'logs')
+    os.makedirs(directory, exist_ok=True)
+
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+        handler.close()
+    if _handler is not None:
+        access_logger.removeHandler(_handler)
+
+    _handler = QueueLogHandler(
+        directory,
+        getattr(settings, 'LOG_MAX_BYTES', MAX_BYTES),
+        getattr(settings, 'LOG_BACKUPS', BACKUPS),
+        getattr(settings, 'LOG_QUEUE_SIZE', QUEUE_SIZE)
+    )
+    _handler.setFormatter(logging.Formatter(FORMAT, DATE_FORMAT))
+    sampling = getattr(settings, 'LOG_SAMPLING', None)
+    if sampling:
+        _handler.addFilter(SamplingFilter(sampling))
+
+    logging.root.addHandler(_handler)
+    logging.root.setLevel(getattr(settings, 'LOG_LEVEL', logging.DEBUG if settings.DEBUG else logging.INFO))
+    if getattr(settings, 'ACCESS_LOG', True):
+        access_logger.addHandler(_handler)
+        access_logger.setLevel(logging.INFO)
+    return _handler
+
+def _after_fork():
+    if _handler is not None:
+        _handler.after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def access(request, status, size, user=None):
+    """Log a finished request in the common log format."""
+    if not access_logger.handlers:
+        return
+    user_id = getattr(user, 'id', None)
+    access_logger.info(
+        '%s - %s [%s] "%s %s %s" %s %s',
+        request.client_addr or '-',
+        '-' if user_id is None else user_id,
+        time.strftime('%d/%b/%Y:%H:%M:%S %z'),
+        request.method,
+        request.path_qs,
+        request.http_version,
+        status,
+        '-' if size is None else size
+    )
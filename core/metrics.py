@@ -0,0 +1,454 @@
+"""
+Application metrics in the Prometheus text format.
+
+When METRICS_PATH (or METRICS = True) is set in settings the framework
+records the latency of each route, response status codes, the admission
+queue, session store reads and writes and DB pool use. The metrics are
+served at METRICS_PATH, eg. '/metrics'.
+
+Under the pre-fork server (see core/server.py) each worker writes its
+metrics to a file in STORAGE_DIR/metrics every FLUSH_INTERVAL seconds and
+the endpoint adds up the files of every worker, so a scrape sees the
+whole server whichever worker answers it. When a worker exits the master
+adds its counters to EXITED_FILE and removes its file.
+
+App specific metrics can be added to the registry:
+    from webframe.core import metrics
+    SIGNUPS = metrics.registry.counter('myapp_signups_total', 'New users.')
+    SIGNUPS.inc()
+"""
+
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # The pre-fork server (and shared metrics) are POSIX only.
+    fcntl = None
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+# Seconds between writes of a worker's metrics file.
+FLUSH_INTERVAL = 1.0
+# The counters and histograms of exited workers, in the shared directory.
+EXITED_FILE = 'exited.json'
+
+# Set from settings by configure().
+enabled = False
+path = None
+
+# The directory of the workers' metrics files, set by enable_shared().
+shared_dir = None
+_flush_lock = threading.Lock()
+
+
+class _Metric(object):
+    """
+    A metric with values for each combination of label values.
+    func, if given, is called on collection and returns the value or a
+    dict of {label values tuple: value}.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=(), func=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.func = func
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """A list of [label values, value]."""
+        if self.func is not None:
+            values = self.func()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return [[list(k), v] for k, v in values.items()]
+        with self._lock:
+            return [[list(k), self._copy(v)] for k, v in self._values.items()]
+
+    def _copy(self, value):
+        return value
+
+    def describe(self):
+        return {'type': self.type, 'help': self.help, 'labels': list(self.labels)}
+
+
+class Counter(_Metric):
+    """A value which only goes up."""
+
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value which goes up and down."""
+
+    type = 'gauge'
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(_Metric):
+    """
+    Counts observations in buckets.
+    Each value is a list of the count in each bucket (the last one is
+    +Inf, not cumulative) followed by the sum of the observations.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[i] += 1
+            state[-1] += value
+
+    def _copy(self, value):
+        return list(value)
+
+    def describe(self):
+        description = super().describe()
+        description['buckets'] = list(self.buckets)
+        return description
+
+
+class Registry(object):
+    """The metrics to collect."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('Metric \'' + metric.name + '\' is already registered.')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=(), func=None):
+        return self.register(Counter(name, help, labels, func))
+
+    def gauge(self, name, help, labels=(), func=None):
+        return self.register(Gauge(name, help, labels, func))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def snapshot(self):
+        """Every metric as a JSON serialisable dict."""
+        snapshot = {}
+        for name, metric in self.metrics.items():
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logging.warning('Unable to collect metric \'%s\'.', name)
+                logging.exception(e)
+                continue
+            snapshot[name] = dict(metric.describe(), samples=samples)
+        return snapshot
+
+
+def merge(snapshots):
+    """Add up the samples of several snapshots."""
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            into = merged.setdefault(name, dict(metric, samples={}))
+            for labels, value in metric['samples']:
+                key = tuple(labels)
+                current = into['samples'].get(key)
+                if current is None:
+                    into['samples'][key] = value
+                elif isinstance(value, list):
+                    into['samples'][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    into['samples'][key] = current + value
+    for metric in merged.values():
+        metric['samples'] = [[list(k), v] for k, v in metric['samples'].items()]
+    return merged
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render(snapshot):
+    """A snapshot in the Prometheus text exposition format."""
+    lines = []
+    for name, metric in snapshot.items():
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["type"]}')
+        names = metric['labels']
+        for values, value in metric['samples']:
+            if metric['type'] != 'histogram':
+                lines.append(f'{name}{_labels(names, values)} {_number(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(metric['buckets'] + [float('inf')], value[:-1]):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f'{name}_bucket{_labels(names, values, le)} {cumulative}')
+            lines.append(f'{name}_sum{_labels(names, values)} {_number(value[-1])}')
+            lines.append(f'{name}_count{_labels(names, values)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def _admission(key):
+    def collect():
+        from webframe.core.wsgi import WSGIApp
+        if WSGIApp.admission is None:
+            return 0
+        return WSGIApp.admission.stats()[key]
+    return collect
+
+REQUEST_DURATION = registry.histogram(
+    'webframe_request_duration_seconds', 'Time taken to handle requests.', ('route',))
+RESPONSES = registry.counter(
+    'webframe_responses_total', 'Responses sent, by status code.', ('route', 'status'))
+REQUESTS_ACTIVE = registry.gauge(
+    'webframe_requests_active', 'Requests being handled.', func=_admission('active'))
+REQUESTS_QUEUED = registry.gauge(
+    'webframe_requests_queued', 'Requests waiting to be admitted.', func=_admission('queued'))
+REQUESTS_REJECTED = registry.counter(
+    'webframe_requests_rejected_total', 'Requests turned away by admission control.',
+    func=_admission('rejected'))
+QUEUE_TIME = registry.counter(
+    'webframe_queue_seconds_total', 'Time admitted requests spent waiting.',
+    func=_admission('queue_time'))
+SESSION_OPERATIONS = registry.counter(
+    'webframe_session_store_operations_total', 'Session store reads, writes and deletes.',
+    ('store', 'operation'))
+DB_CONNECTIONS = registry.counter(
+    'webframe_db_connections_opened_total', 'New DB connections opened by the pool.')
+DB_CHECKOUTS = registry.counter(
+    'webframe_db_pool_checkouts_total', 'Connections taken from the DB pool.')
+DB_CHECKED_OUT = registry.gauge(
+    'webframe_db_pool_checked_out', 'Connections currently taken from the DB pool.')
+
+
+def configure(settings):
+    global enabled, path
+    path = getattr(settings, 'METRICS_PATH', None)
+    enabled = path is not None or getattr(settings, 'METRICS', False)
+    if enabled:
+        instrument_engine(settings.ENGINE)
+
+def _on_connect(dbapi_connection, connection_record):
+    DB_CONNECTIONS.inc()
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_CHECKOUTS.inc()
+    DB_CHECKED_OUT.inc()
+
+def _on_checkin(dbapi_connection, connection_record):
+    DB_CHECKED_OUT.dec()
+
+def instrument_engine(engine):
+    """Count the connections of the engine's pool."""
+    from sqlalchemy import event
+    if event.contains(engine, 'checkout', _on_checkout):
+        return
+    event.listen(engine, 'connect', _on_connect)
+    event.listen(engine, 'checkout', _on_checkout)
+    event.listen(engine, 'checkin', _on_checkin)
+
+def route_label(route):
+    """The route label for a route, its name or else its path."""
+    if route is None:
+        return 'unmatched'
+    if route.__class__.__name__ == 'ResourceRoute':
+        return 'resource'
+    return route.name or route.route_params.get('path', '')
+
+def record_request(route, status, seconds):
+    """Record a finished request."""
+    if not enabled:
+        return
+    label = route_label(route)
+    REQUEST_DURATION.observe(seconds, label)
+    RESPONSES.inc(label, str(status))
+
+def record_session(store, operation):
+    if enabled:
+        SESSION_OPERATIONS.inc(store, operation)
+
+
+def enable_shared(directory):
+    """
+    Called by the pre-fork master before forking. Clears the metrics left
+    by a previous run.
+    """
+    global shared_dir
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith('.json') or name.endswith('.tmp'):
+            os.remove(os.path.join(directory, name))
+    shared_dir = directory
+
+def after_fork():
+    """Start a worker's metrics afresh and write them out periodically."""
+    registry.reset()
+    if shared_dir is None:
+        return
+    thread = threading.Thread(target=_flush_loop, name='webframe-metrics', daemon=True)
+    thread.start()
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush()
+
+def flush():
+    """Write this process's metrics to its file in the shared directory."""
+    if shared_dir is None or not _flush_lock.acquire(blocking=False):
+        return
+    try:
+        file = os.path.join(shared_dir, f'{os.getpid()}.json')
+        tmp = file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(registry.snapshot(), f)
+        # Readers never see a half written file.
+        os.replace(tmp, file)
+    except OSError as e:
+        logging.warning('Unable to write metrics.')
+        logging.exception(e)
+    finally:
+        _flush_lock.release()
+
+@contextmanager
+def _shared_lock(exclusive=False):
+    """Keeps readers from seeing an exited worker both in its file and EXITED_FILE."""
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(shared_dir, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _load(file):
+    try:
+        with open(file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _without_gauges(snapshot):
+    return {k: v for k, v in snapshot.items() if v['type'] != 'gauge'}
+
+def retire(pid):
+    """
+    Called by the pre-fork master when it reaps a worker. Adds the worker's
+    counters and histograms to EXITED_FILE and removes its file, so the
+    files do not pile up as workers are recycled.
+    """
+    if shared_dir is None:
+        return
+    file = os.path.join(shared_dir, f'{pid}.json')
+    exited = os.path.join(shared_dir, EXITED_FILE)
+    try:
+        with _shared_lock(exclusive=True):
+            snapshot = _load(file)
+            if snapshot:
+                merged = merge([_load(exited), _without_gauges(snapshot)])
+                with open(exited + '.tmp', 'w') as f:
+                    json.dump(merged, f)
+                os.replace(exited + '.tmp', exited)
+            for name in (file, file + '.tmp'):
+                try:
+                    os.remove(name)
+                except FileNotFoundError:
+                    pass
+    except (OSError, ValueError) as e:
+        logging.warning('Unable to collect the metrics of worker %s.', pid)
+        logging.exception(e)
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def _read_shared():
+    """The snapshots of every worker. Gauges of exited workers are left out."""
+    snapshots = []
+    with _shared_lock():
+        for name in os.listdir(shared_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(shared_dir, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if name != EXITED_FILE and not _alive(int(name[:-5])):
+                # Exited, but not yet retired by the master.
+                snapshot = _without_gauges(snapshot)
+            snapshots.append(snapshot)
+    return snapshots
+
+def exposition():
+    """The metrics of this process, or of every worker, in the text format."""
+    if shared_dir is None:
+        return render(registry.snapshot())
+    flush()
+    return render(merge(_read_shared()))
+
+def response(request):
+    """The response for a scrape of METRICS_PATH."""
+    from webframe.core.http.responses import Response
+    response = Response(request)
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.text = exposition()
+    return response
@@ -0,0 +1,123 @@
+"""
+Sampled request profiling.
+
+A fraction of requests are run under cProfile and the stats are saved to
+STORAGE_DIR/profiles/<route name>/ for `python project.py profile:report`.
+The last MAX_FILES profiles of each route are kept.
+
+Settings:
+    PROFILE_RATE: the fraction of requests to profile, eg. 0.01 (0 is off).
+    PROFILE_TOKEN: requests with an 'X-Profile: <token>' header are always
+        profiled (None is off).
+Routes can set 'profile' to their own rate, eg. 'profile': 0.1.
+
+One request per process is profiled at a time, requests sampled while
+another is being profiled are handled as usual.
+"""
+
+import os
+import re
+import sys
+import glob
+import time
+import random
+import pstats
+import cProfile
+import logging
+import itertools
+import threading
+from webframe.core import metrics
+
+HEADER = 'X-Profile'
+# Profiles kept for each route, the oldest are removed to make room.
+MAX_FILES = 200
+
+# Set from settings by configure().
+rate = 0.0
+token = None
+directory = None
+
+_lock = threading.Lock()
+_count = itertools.count()
+
+
+def configure(settings):
+    global rate, token, directory
+    rate = getattr(settings, 'PROFILE_RATE', 0) or 0
+    token = getattr(settings, 'PROFILE_TOKEN', None)
+    directory = os.path.join(settings.STORAGE_DIR, 'profiles')
+
+def _wanted(request, route):
+    if token is not None and request.headers.get(HEADER) == token:
+        return True
+    route_rate = rate
+    params = getattr(route, 'route_params', None)
+    if params:
+        route_rate = params.get('profile', rate)
+    return route_rate > 0 and random.random() < route_rate
+
+def start(request, route):
+    """A running profiler if the request is to be profiled, otherwise None."""
+    if not _wanted(request, route) or not _lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler (eg. a debugger) is active.
+        _lock.release()
+        return None
+    return profiler
+
+def finish(profiler, route):
+    """Stop the profiler and save its stats."""
+    try:
+        profiler.disable()
+    finally:
+        _lock.release()
+    try:
+        _save(profiler, route)
+    except OSError as e:
+        logging.warning('Unable to save profile.')
+        logging.exception(e)
+
+def _route_dir(route):
+    return os.path.join(directory, re.sub(r'[^A-Za-z0-9_.-]', '_', metrics.route_label(route)))
+
+def _save(profiler, route):
+    route_dir = _route_dir(route)
+    os.makedirs(route_dir, exist_ok=True)
+    _rotate(route_dir)
+    name = f'{int(time.time() * 1000)}-{os.getpid()}-{next(_count)}.prof'
+    profiler.dump_stats(os.path.join(route_dir, name))
+
+def _rotate(route_dir):
+    """Remove the oldest profiles of a route so one more can be saved."""
+    names = [name for name in os.listdir(route_dir) if name.endswith('.prof')]
+    if len(names) < MAX_FILES:
+        return
+    # Named from the time they were saved.
+    names.sort(key=lambda name: int(name.split('-')[0]) if name.split('-')[0].isdigit() else 0)
+    for name in names[:len(names) - MAX_FILES + 1]:
+        try:
+            os.remove(os.path.join(route_dir, name))
+        except FileNotFoundError:
+            # Removed by another process.
+            pass
+
+def report(profiles_dir, route=None, limit=30, stream=sys.stdout):
+    """Print the slowest functions of the saved profiles, for a route or every route."""
+    pattern = '*' if route is None else re.sub(r'[^A-Za-z0-9_.-]', '_', route)
+    files = glob.glob(os.path.join(profiles_dir, pattern, '*.prof'))
+    if not files:
+        print('No profiles found in ' + profiles_dir, file=stream)
+        return
+    stats = pstats.Stats(*files, stream=stream)
+    stats.strip_dirs()
+    # Do not list every file in the report.
+    stats.files = []
+    print(f'{len(files)} profiles of {route or "every route"}.', file=stream)
+    print('\nBy time spent in the function itself:', file=stream)
+    stats.sort_stats('tottime').print_stats(limit)
+    print('By time spent in the function and its calls:', file=stream)
+    stats.sort_stats('cumulative').print_stats(limit)
@@ -1,14 +1,125 @@
 """This file is in charge of routing."""
-from urllib.parse import urlparse
-from parse import parse
+import re
+import uuid
+import decimal
+from functools import lru_cache
+from urllib.parse import quote, urlencode
 from webframe.utils.errors import abort
 from webframe.core import app
 
+# Number of fully built urls kept by each router.
+URL_CACHE_SIZE = 2048
+
+
+def _to_int(segment):
+    """Only plain unsigned digits, int() would also accept '+1', ' 1' or '1_0'."""
+    if not (segment.isascii() and segment.isdigit()):
+        raise ValueError(f'Invalid integer: {segment}')
+    return int(segment)
+
+def _to_str(segment):
+    return segment
+
+def _pattern(regex, convert=_to_str):
+    """A converter for segments which fully match a regex."""
+    compiled = re.compile(regex)
+    def converter(segment):
+        if compiled.fullmatch(segment) is None:
+            raise ValueError(f'Invalid segment: {segment}')
+        return convert(segment)
+    return converter
+
+def _to_thousands(segment):
+    return int(segment.replace(',', '').replace('.', ''))
+
+_NUMBER = r'[-+ ]?\d*\.\d+'
+
+# Route parameter converters by name, eg. {user_id:int}.
+# A converter takes the path segment and returns the converted value.
+# It must raise ValueError if the segment is not valid, the route will
+# then not match.
+CONVERTERS = {
+    'str': _to_str,
+    'int': _to_int,
+    'uuid': uuid.UUID,
+    # The parse module's format specs, which routes used before converters.
+    'd': _to_int,
+    'w': _pattern(r'\w+'),
+    'W': _pattern(r'\W+'),
+    'l': _pattern(r'[A-Za-z]+'),
+    'D': _pattern(r'\D+'),
+    'S': _pattern(r'\S+'),
+    'n': _pattern(r'\d{1,3}([,.]\d{3})*', _to_thousands),
+    'f': _pattern(_NUMBER, float),
+    'F': _pattern(_NUMBER, decimal.Decimal),
+    'e': _pattern(_NUMBER + r'[eE][-+]?\d+|nan|NAN|inf|INF', float),
+    'g': _pattern(r'[-+ ]?\d+(\.\d+)?([eE][-+]?\d+)?|nan|NAN|inf|INF', float),
+    'x': _pattern(r'(0[xX])?[0-9a-fA-F]+', lambda segment: int(segment, 16)),
+    'o': _pattern(r'(0[oO])?[0-7]+', lambda segment: int(segment, 8)),
+    'b': _pattern(r'(0[bB])?[01]+', lambda segment: int(segment, 2)),
+}
+
+def register_converter(name, converter):
+    """
+    Register a route parameter converter.
+    Must be called before the router is built (eg. in settings.py).
+    """
+    CONVERTERS[name] = converter
+
+
+def split_path(path):
+    """Split a path into its segments, ignoring empty segments."""
+    return tuple(piece for piece in path.split('/') if piece != '')
+
+def is_param(segment):
+    """True if the route segment is a parameter (eg. {user_id})."""
+    return segment[0] == '{' and segment[-1] == '}'
+
+def parse_param(segment):
+    """
+    Split a parameter segment into its name and converter name.
+    eg. '{user_id:int}' -> ('user_id', 'int'), '{slug}' -> ('slug', 'str')
+    """
+    name, _, converter = segment[1:-1].partition(':')
+    return name.strip(), converter.strip() or 'str'
+
+
 class Router():
-    """The router."""
+    """
+    The router.
+
+    The routes are compiled when the router is built into one dispatch
+    table per method, plus one for routes without a method. The cost of
+    a lookup depends on the depth of the path, not the number of routes.
+    Where more than one route matches, the first in the routes list wins.
+    """
+
+    def __init__(self, routes, host=''):
+        self.routes = tuple(routes)
+        # Prepended to urls built with include_host, eg. http://localhost:8000
+        self.host = host
+        self._tables = {}
+        self._any_method = _DispatchTable()
+        # Route name -> url builder, the first route with a name wins.
+        self._builders = {}
+
+        for index, route_params in enumerate(self.routes):
+            self._table_for(route_params).add(index, route_params)
+            try:
+                self._builders.setdefault(route_params['name'], _UrlBuilder(route_params['path']))
+            except KeyError:
+                pass
 
-    def __init__(self, routes):
-        self.routes = routes
+        self._cached_url = lru_cache(maxsize=URL_CACHE_SIZE)(self._build_cached_url)
+
+    def _table_for(self, route_params):
+        """Get the dispatch table the route belongs in."""
+        try:
+            method = route_params['method'].upper()
+        except KeyError:
+            # No method so don't filter by it.
+            return self._any_method
+        return self._tables.setdefault(method, _DispatchTable())
 
     def get_route(self, request):
         """
@@ -19,65 +130,213 @@ class Router():
             if request.path.startswith(app.userapp.settings.RESOURCE_URL):
                 return ResourceRoute(request.path)
 
-        found = None
-        for route_params in self.routes:
+        found = self.match(request.method, request.path)
 
-            if not self.__match(route_params, request):
-                continue
-
-            found = Route(route_params, request.path)
-            break
-        
         if not found:
             abort(404)
 
         return found
 
-    def __match(self, route_params, request):
-        """Check if route params match method, path, etc of request."""
-        # Method match?
+    def match(self, method, path):
+        """Match the method and path to a route. Returns None if not found."""
+        segments = split_path(path)
+
+        found = self._any_method.match(segments)
+        table = self._tables.get(method.upper())
+        if table is not None:
+            by_method = table.match(segments, found)
+            if by_method is not None:
+                found = by_method
+
+        if found is None:
+            return None
+
+        index, route_params, params = found
+        return Route(route_params, params)
+
+    def url(self, name, args=None, get=None, include_host=False):
+        """Build the url of a named route. Returns None if there is no such route."""
+        # Parameters are built with str(), so eg. 1 and True (which are equal
+        # and hash alike) are not given the same cached url.
+        args = tuple((k, str(v)) for k, v in args.items()) if args else ()
+        get = tuple(get.items()) if get else ()
+        try:
+            return self._cached_url(name, args, get, include_host, _types(get))
+        except TypeError:
+            # Unhashable argument values (eg. a list of GET values).
+            return self._build_url(name, args, get, include_host)
+
+    def _build_cached_url(self, name, args, get, include_host, types):
+        """_build_url() for the cache, types keeps GET values of other types apart."""
+        return self._build_url(name, args, get, include_host)
+
+    def _build_url(self, name, args, get, include_host):
         try:
-            method = route_params['method']
-            if method.upper() != request.method.upper():
-                return False
+            builder = self._builders[name]
         except KeyError:
-            # No method so don't filter by it.
-            pass
+            return None
+
+        url = builder.build(dict(args))
+        if get:
+            url += '?' + urlencode(get, doseq=True)
+        if include_host:
+            url = self.host + url
+        return url
 
-        return self.__is_route_match(route_params['path'], request.path)
 
-    def __is_route_match(self, candidate, requested):
-        """Return dictionary of callables."""
-        # TODO implement a better algorithm for this (more efficient)
-        # split and remove empty.
-        requested = [piece for piece in requested.split('/') if piece != '']
-        candidate = [piece for piece in candidate.split('/') if piece != '']
+def _types(get):
+    """The types of GET values (and of the items of tuple values)."""
+    return tuple(
+        tuple(map(type, v)) if isinstance(v, tuple) else type(v)
+        for _, v in get
+    )
 
-        if len(requested) != len(candidate):
-            return False
 
-        for req, cand in zip(requested, candidate):
-            # If candidate is a param then skip
-            if cand[0] == '{' and cand[-1] == '}':
+class _Node():
+    """A node in the segment trie of parameterised routes."""
+
+    __slots__ = ('static', 'params', 'route', 'first')
+
+    def __init__(self):
+        # Literal segment -> child node.
+        self.static = {}
+        # (param name, converter, child node) in the order they were added.
+        self.params = []
+        # (index, route_params) of the first route ending at this node.
+        self.route = None
+        # Lowest route index in this subtree, used to prune the search.
+        self.first = None
+
+
+class _DispatchTable():
+    """
+    The compiled routes for one method.
+
+    Static paths are held in a dict keyed by their segments, parameterised
+    paths in a trie of segments.
+    """
+
+    __slots__ = ('static', 'root')
+
+    def __init__(self):
+        self.static = {}
+        self.root = _Node()
+
+    def add(self, index, route_params):
+        """Add a route, the index is its position in the routes list."""
+        segments = split_path(route_params['path'])
+
+        if not any(is_param(segment) for segment in segments):
+            self.static.setdefault(segments, (index, route_params))
+            return
+
+        node = self.root
+        self._visit(node, index)
+        for segment in segments:
+            if is_param(segment):
+                try:
+                    node = self._param_child(node, *parse_param(segment))
+                except ValueError as e:
+                    route = route_params.get('name') or route_params['path']
+                    raise ValueError(f'Route \'{route}\': {e}') from None
+            else:
+                node = node.static.setdefault(segment, _Node())
+            self._visit(node, index)
+
+        if node.route is None:
+            node.route = (index, route_params)
+
+    def _visit(self, node, index):
+        if node.first is None:
+            node.first = index
+
+    def _param_child(self, node, name, converter_name):
+        try:
+            converter = CONVERTERS[converter_name]
+        except KeyError:
+            raise ValueError(f'Unknown route parameter converter: {converter_name}')
+
+        for param, convert, child in node.params:
+            if param == name and convert is converter:
+                return child
+        child = _Node()
+        node.params.append((name, converter, child))
+        return child
+
+    def match(self, segments, best=None):
+        """
+        Returns (index, route_params, params) of the first matching route.
+        If best is given only routes before it are considered.
+        """
+        static = self.static.get(segments)
+        if static is not None and (best is None or static[0] < best[0]):
+            best = (static[0], static[1], {})
+
+        if self.root.first is None:
+            return best
+        return self._match(self.root, segments, 0, [], best)
+
+    def _match(self, node, segments, depth, values, best):
+        """Depth first search of the trie, keeping the lowest index match."""
+        if best is not None and node.first >= best[0]:
+            return best
+
+        if depth == len(segments):
+            if node.route is not None and (best is None or node.route[0] < best[0]):
+                best = (node.route[0], node.route[1], dict(values))
+            return best
+
+        segment = segments[depth]
+        child = node.static.get(segment)
+        if child is not None:
+            best = self._match(child, segments, depth + 1, values, best)
+
+        for name, convert, child in node.params:
+            if best is not None and child.first >= best[0]:
                 continue
-            # Break if any differences found.
-            if req != cand:
-                return False
+            try:
+                value = convert(segment)
+            except ValueError:
+                continue
+            values.append((name, value))
+            best = self._match(child, segments, depth + 1, values, best)
+            values.pop()
+
+        return best
+
+
+class _UrlBuilder():
+    """The path of a route, split once into literal text and parameters."""
+
+    __slots__ = ('pieces', 'params')
+
+    # Path segment characters which do not need quoting.
+    SAFE = "!$&'()*+,;=:@"
+
+    def __init__(self, path):
+        # Literal text at even indexes, parameters at odd indexes.
+        self.pieces = re.split(r'(\{[^}]*\})', path)
+        self.params = tuple(
+            (i, parse_param(self.pieces[i])[0])
+            for i in range(1, len(self.pieces), 2)
+        )
 
-        return True
+    def build(self, args):
+        """Fill in the parameters, raises KeyError if one is missing."""
+        pieces = list(self.pieces)
+        for i, name in self.params:
+            pieces[i] = quote(str(args[name]), safe=self.SAFE)
+        return ''.join(pieces)
 
 
 class Route():
     """Wrapper for a route and its information."""
 
-    def __init__(self, route_params, path):
+    def __init__(self, route_params, params=None):
         self.route_params = route_params
 
-        # extract the route parameters
-        parsed_path = parse(route_params['path'], path)
-        self.params = {}
-        if parsed_path:
-            self.params = parsed_path.named
+        # The route parameters extracted while matching.
+        self.params = params if params is not None else {}
 
         self.callable = route_params['command']
 
@@ -103,4 +362,4 @@ class ResourceRoute():
     """Wrapper for public resource route."""
 
     def __init__(self, path):
-        self.path = path.split(app.userapp.settings.RESOURCE_URL)[1]
\ No newline at end of file
+        self.path = path[len(app.userapp.settings.RESOURCE_URL):]
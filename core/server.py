@@ -0,0 +1,312 @@
+"""
+Pre-forking production server.
+
+The master process loads the app, binds the listening socket, freezes
+the loaded objects with gc.freeze() so they stay shared copy-on-write
+and forks the workers. Every worker accepts connections on the shared
+socket and handles them in threads.
+
+Workers are recycled after MAX_REQUESTS requests or once their memory
+use passes MAX_WORKER_RSS megabytes (0 disables either).
+
+Signals sent to the master:
+    SIGTERM, SIGINT: finish the requests in progress and stop.
+    SIGHUP: start a new set of workers, then gracefully stop the old ones.
+        The socket is never closed so no connections are refused. The app
+        is preloaded in the master, so code changes need a full restart.
+
+POSIX only.
+"""
+
+import os
+import gc
+import sys
+import time
+import errno
+import signal
+import socket
+import logging
+import resource
+import threading
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+from webframe.core import app, context, metrics
+from webframe.core.http.files import FileWrapper
+
+# Seconds given to workers to finish their requests when stopping.
+GRACEFUL_TIMEOUT = 30
+
+
+class _ServerHandler(ServerHandler):
+    """Sends file bodies (see core/http/files.py) with sendfile()."""
+
+    wsgi_file_wrapper = FileWrapper
+
+    def sendfile(self):
+        wrapper = self.result
+        if not wrapper.sendable():
+            return False
+        if not self.headers_sent:
+            self.send_headers()
+        self.bytes_sent += self.request_handler.connection.sendfile(
+            wrapper.file,
+            wrapper.offset,
+            wrapper.length
+        )
+        return True
+
+
+class _RequestHandler(WSGIRequestHandler):
+
+    def handle(self):
+        """As WSGIRequestHandler.handle(), with _ServerHandler."""
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        handler = _ServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+            multithread=False,
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s', self.address_string(), format % args)
+
+
+class _WorkerServer(ThreadingMixIn, WSGIServer):
+    """A threaded WSGI server on an already listening socket."""
+
+    daemon_threads = False
+    # Wait for request threads on server_close() (python 3.7+).
+    block_on_close = True
+
+    def __init__(self, listener):
+        WSGIServer.__init__(
+            self,
+            listener.getsockname()[:2],
+            _RequestHandler,
+            bind_and_activate=False
+        )
+        self.socket.close()
+        self.socket = listener
+        host, port = listener.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+
+
+def _rss_megabytes():
+    """Peak resident memory of this process."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on linux, bytes on macOS.
+    if sys.platform == 'darwin':
+        rss = rss / 1024
+    return rss / 1024
+
+
+class Worker(object):
+    """Serves requests in a forked process until stopped or recycled."""
+
+    def __init__(self, wsgi_app, listener, max_requests=0, max_rss=0):
+        self.wsgi_app = wsgi_app
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.handled = 0
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.server = _WorkerServer(listener)
+        self.server.set_app(self._counted)
+
+    def _counted(self, environ, start_response):
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            with self._lock:
+                self.handled += 1
+                handled = self.handled
+            if self.max_requests and handled >= self.max_requests:
+                logging.info('Worker %s served %s requests, recycling.', os.getpid(), handled)
+                self.stop()
+            elif self.max_rss and _rss_megabytes() > self.max_rss:
+                logging.info('Worker %s is over %sMB, recycling.', os.getpid(), self.max_rss)
+                self.stop()
+
+    def stop(self, *args):
+        """Stop accepting connections, requests in progress are finished."""
+        if self._stopping:
+            return
+        self._stopping = True
+        # shutdown() waits for serve_forever() so must not run on its thread.
+        threading.Thread(target=self.server.shutdown).start()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        try:
+            self.server.serve_forever(poll_interval=0.5)
+        finally:
+            # Waits for the request threads.
+            self.server.server_close()
+
+
+class PreforkServer(object):
+    """The master process, it keeps WORKERS workers running."""
+
+    def __init__(self, wsgi_app, settings, workers=None, shutdown=None):
+        """
+        wsgi_app: the loaded app (eg. app() from myapp/wsgi.py)
+        shutdown: called in each worker as it exits (eg. WSGIApp.shutdown)
+        """
+        self.wsgi_app = wsgi_app
+        self.settings = settings
+        self.host = settings.HOST
+        self.port = settings.PORT or 8000
+        self.num_workers = workers or getattr(settings, 'WORKERS', None) or os.cpu_count() or 1
+        self.max_requests = getattr(settings, 'MAX_REQUESTS', 0)
+        self.max_rss = getattr(settings, 'MAX_WORKER_RSS', 0)
+        self.shutdown = shutdown
+        self.listener = None
+        # pid -> generation, the generation goes up on each reload.
+        self.workers = {}
+        self.generation = 0
+        self._stopping = False
+        self._reload = False
+
+    def run(self):
+        """Run the master until it is told to stop."""
+        self.listener = self._listen()
+        logging.info('Serving on %s:%s with %s workers.', self.host, self.port, self.num_workers)
+        print(f'Serving on {self.host}:{self.port} with {self.num_workers} workers.')
+
+        if metrics.enabled:
+            metrics.enable_shared(os.path.join(self.settings.STORAGE_DIR, 'metrics'))
+        self._before_fork()
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+
+        try:
+            while not self._stopping:
+                self._reap()
+                if self._reload:
+                    self._reload = False
+                    self._rolling_reload()
+                self._spawn_missing()
+                time.sleep(0.5)
+        finally:
+            self._stop_workers()
+            self.listener.close()
+
+    def _listen(self):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(getattr(self.settings, 'BACKLOG', 2048))
+        return listener
+
+    def _before_fork(self):
+        """Leave nothing in the master which the workers should not share."""
+        context.current().close_db()
+        self.settings.ENGINE.dispose()
+        gc.collect()
+        # Keep the preloaded objects out of the collector so their pages
+        # are not written to (and copied) by collections in the workers.
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+    def _handle_stop(self, *args):
+        self._stopping = True
+
+    def _handle_reload(self, *args):
+        self._reload = True
+
+    def _current_workers(self):
+        return [pid for pid, gen in self.workers.items() if gen == self.generation]
+
+    def _spawn_missing(self):
+        while not self._stopping and len(self._current_workers()) < self.num_workers:
+            self._spawn()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = self.generation
+            return
+
+        # In the worker.
+        code = 0
+        try:
+            self._after_fork()
+            Worker(self.wsgi_app, self.listener, self.max_requests, self.max_rss).run()
+            metrics.flush()
+            if self.shutdown is not None:
+                self.shutdown()
+        except BaseException as e:
+            logging.exception(e)
+            code = 1
+        finally:
+            # os._exit() skips atexit, write out the queued log records.
+            logging.shutdown()
+            os._exit(code)
+
+    def _after_fork(self):
+        # Connections in the pool belong to the master, drop them without closing.
+        try:
+            self.settings.ENGINE.dispose(close=False)
+        except TypeError:
+            # SQLAlchemy < 1.4.33
+            self.settings.ENGINE.dispose()
+        metrics.after_fork()
+        for hook in app.after_fork_hooks:
+            hook(app.userapp)
+
+    def _rolling_reload(self):
+        """Start new workers before stopping the old ones."""
+        logging.info('Reloading workers...')
+        old = list(self.workers)
+        self.generation += 1
+        self._spawn_missing()
+        for pid in old:
+            self._signal(pid, signal.SIGTERM)
+
+    def _reap(self):
+        """Collect exited workers, they are replaced by _spawn_missing()."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            self.workers.pop(pid, None)
+            metrics.retire(pid)
+            if status:
+                logging.warning('Worker %s exited with status %s.', pid, status)
+
+    def _signal(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _stop_workers(self):
+        """Gracefully stop every worker, killing any still running after GRACEFUL_TIMEOUT."""
+        for pid in list(self.workers):
+            self._signal(pid, signal.SIGTERM)
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        while self.workers and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            self._signal(pid, signal.SIGKILL)
+        self._reap()
@@ -0,0 +1,220 @@
+"""
+Public resource serving.
+
+With SERVE_PUBLIC set, requests under RESOURCE_URL are answered by a
+StaticServer for RESOURCE_DIR. Files up to STATIC_MAX_FILE_SIZE are kept
+in memory, in an LRU bounded by STATIC_CACHE_BYTES, and are read again
+when their size or modified time changes. Larger files are streamed from
+disk.
+
+Responses carry an ETag, Last-Modified and 'Cache-Control: public,
+max-age=STATIC_MAX_AGE' and answer conditional and Range requests. A
+precompressed 'file.gz' next to a file is sent to clients accepting gzip.
+Fingerprinted files (see core/assets.py) are cached for a year and marked
+'immutable'.
+"""
+
+import os
+import stat
+import mimetypes
+import threading
+from email.utils import formatdate
+from collections import OrderedDict
+from webframe.core.http.responses import Response
+from webframe.core.http import files
+from webframe.core import assets
+from webframe.middleware.compression import negotiate, STRONG_VALIDATORS
+
+MAX_AGE = 3600
+# For fingerprinted files, whose content never changes.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+CACHE_BYTES = 32 * 1024 * 1024
+# Larger files are not kept in memory.
+MAX_FILE_SIZE = 256 * 1024
+
+
+class _File(object):
+    """
+    A file found below the root, with its body if it is small enough to
+    keep. Without a stat result it records that there is no such file.
+    """
+
+    __slots__ = ('path', 'version', 'headers', 'body', 'size')
+
+    def __init__(self, path, st, body=None):
+        self.path = path
+        self.version = _version(st)
+        self.body = body
+        self.size = len(body or b'') + len(path) + 200
+        if st is None:
+            self.headers = None
+            return
+        content_type, encoding = mimetypes.guess_type(path)
+        content_type = content_type or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type == 'application/javascript':
+            content_type += '; charset=UTF-8'
+        self.headers = [
+            ('Content-Type', content_type),
+            ('ETag', '"%x-%x"' % (st.st_mtime_ns, st.st_size)),
+            ('Last-Modified', _http_date(st.st_mtime)),
+            ('Accept-Ranges', 'bytes'),
+        ]
+        if encoding is not None:
+            self.headers.append(('Content-Encoding', encoding))
+
+
+def _version(st):
+    if st is None:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+class StaticServer(object):
+    """Serves the files below a directory."""
+
+    def __init__(self, root, max_age=MAX_AGE, cache_bytes=CACHE_BYTES, max_file_size=MAX_FILE_SIZE):
+        self.root = os.path.realpath(root)
+        self.max_age = max_age
+        self.cache_bytes = cache_bytes
+        self.max_file_size = max_file_size
+        self.size = 0
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_settings(settings):
+        return StaticServer(
+            settings.RESOURCE_DIR,
+            getattr(settings, 'STATIC_MAX_AGE', MAX_AGE),
+            getattr(settings, 'STATIC_CACHE_BYTES', CACHE_BYTES),
+            getattr(settings, 'STATIC_MAX_FILE_SIZE', MAX_FILE_SIZE)
+        )
+
+    def resolve(self, path):
+        """The real path of a URL path below the root, None if it would lead out of it."""
+        parts = []
+        for part in path.split('/'):
+            if part in ('', '.'):
+                continue
+            if part == '..' or '\x00' in part or os.sep in part or (os.altsep and os.altsep in part):
+                return None
+            parts.append(part)
+        if not parts:
+            return None
+        real = os.path.realpath(os.path.join(self.root, *parts))
+        # Symlinks may not lead out of the root either.
+        if os.path.commonpath([self.root, real]) != self.root:
+            return None
+        return real
+
+    def _get(self, path):
+        """The (cached) file for a URL path, None if there is no such file."""
+        with self._lock:
+            found = self._files.get(path)
+        if found is not None:
+            try:
+                st = os.stat(found.path)
+            except OSError:
+                st = None
+            if _version(st) == found.version:
+                with self._lock:
+                    if path in self._files:
+                        self._files.move_to_end(path)
+                return found if found.headers is not None else None
+            self._remove(path, found)
+
+        real = self.resolve(path)
+        if real is None:
+            return None
+        try:
+            st = os.stat(real)
+        except FileNotFoundError:
+            # Remembered, eg. most files have no .gz to look for.
+            self._store(path, _File(real, None))
+            return None
+        except OSError:
+            return None
+        try:
+            if not stat.S_ISREG(st.st_mode):
+                return None
+            body = None
+            if st.st_size <= self.max_file_size:
+                with open(real, 'rb') as f:
+                    body = f.read()
+                    st = os.fstat(f.fileno())
+        except OSError:
+            return None
+        if body is not None and len(body) != st.st_size:
+            # Changed while it was read, serve it from disk this time.
+            body = None
+        found = _File(real, st, body)
+        self._store(path, found)
+        return found
+
+    def _store(self, path, found):
+        if found.size > self.cache_bytes:
+            return
+        with self._lock:
+            old = self._files.pop(path, None)
+            if old is not None:
+                self.size -= old.size
+            self._files[path] = found
+            self.size += found.size
+            while self.size > self.cache_bytes:
+                _, evicted = self._files.popitem(last=False)
+                self.size -= evicted.size
+
+    def _remove(self, path, found):
+        with self._lock:
+            if self._files.get(path) is found:
+                del self._files[path]
+                self.size -= found.size
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+            self.size = 0
+
+    def response(self, request, path):
+        """The response for the file at a URL path, None if there is no such file."""
+        found = self._get(path)
+        if found is None:
+            return None
+        headers = found.headers
+        compressed = self._get(path + '.gz') if not path.endswith('.gz') else None
+        # Ignored if older than the file.
+        if compressed is not None and compressed.version[0] >= found.version[0]:
+            if negotiate(request.headers.get('Accept-Encoding', '')) == 'gzip':
+                # The type of the file, the validators (and Content-Encoding) of the .gz.
+                headers = [found.headers[0]] + compressed.headers[1:]
+                found = compressed
+            headers = headers + [('Vary', 'Accept-Encoding')]
+        if assets.is_fingerprinted(path):
+            headers = headers + [('Cache-Control', IMMUTABLE_CACHE_CONTROL)]
+        else:
+            headers = headers + [('Cache-Control', f'public, max-age={self.max_age}')]
+
+        if found.body is None:
+            # Sent by the front proxy when SENDFILE_BACKEND is set.
+            offloaded = files.offload(request, found.path, headers)
+            if offloaded is not None:
+                return offloaded
+
+        response = Response(request)
+        response.headerlist = headers
+        if found.body is not None:
+            response.body = found.body
+        else:
+            try:
+                file = open(found.path, 'rb')
+            except OSError:
+                return None
+            response.app_iter = files.file_iter(request, file)
+            response.content_length = os.fstat(file.fileno()).st_size
+        response.conditional_response = True
+        # The ETag is the file's, so the compressed copy can be found by it.
+        request.environ[STRONG_VALIDATORS] = True
+        return response
@@ -0,0 +1,105 @@
+"""
+Per request phase timing.
+
+When TIMING is True in settings, the phases of each request (routing,
+middleware, form validation, the view, template rendering, ...) are
+timed and the timings are passed to the registered collectors once the
+request is finished. SERVER_TIMING adds a Server-Timing header so the
+timings show up in the browser's developer tools.
+
+Time a block of code with:
+    with timing.phase('my_phase'):
+        ...
+When timing is disabled phase() returns a shared do nothing object.
+"""
+
+import time
+import logging
+from webframe.core import context
+
+# Set from settings by configure().
+enabled = False
+server_timing = False
+
+# Callables called with (request, timings) once a request has finished.
+# timings is a list of (phase name, seconds) in the order they finished.
+collectors = []
+
+
+def configure(settings):
+    global enabled, server_timing
+    server_timing = getattr(settings, 'SERVER_TIMING', False)
+    enabled = getattr(settings, 'TIMING', False) or server_timing or bool(collectors)
+
+def add_collector(func):
+    """Register a collector, this enables timing."""
+    global enabled
+    collectors.append(func)
+    enabled = True
+    return func
+
+
+class _NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.append((self.name, time.perf_counter() - self.start))
+        return False
+
+
+def phase(name):
+    """Time a block of the current request."""
+    if not enabled:
+        return _NULL_PHASE
+    timings = context.current().timings
+    if timings is None:
+        return _NULL_PHASE
+    return _Phase(timings, name)
+
+def start(ctx):
+    """Start timing the request of the context, if timing is enabled."""
+    if enabled:
+        ctx.timings = []
+
+def header(timings):
+    """The Server-Timing header value, phases with the same name are summed."""
+    totals = {}
+    for name, seconds in timings:
+        totals[name] = totals.get(name, 0.0) + seconds
+    return ', '.join(f'{name};dur={seconds * 1000:.2f}' for name, seconds in totals.items())
+
+def set_header(response, timings):
+    """Add the Server-Timing header if enabled."""
+    if server_timing and timings is not None and hasattr(response, 'headers'):
+        response.headers['Server-Timing'] = header(timings)
+
+def collect(ctx):
+    """Pass the timings of a finished request to the collectors."""
+    if ctx.timings is None:
+        return
+    for collector in collectors:
+        try:
+            collector(ctx.request, ctx.timings)
+        except Exception as e:
+            logging.error('Error in timing collector.')
+            logging.exception(e)
@@ -1,79 +1,241 @@
 # -*- coding: utf-8 -*-
 """The WSGI entry/communication point for the app."""
 
-import os
 import sys
+import time
 import traceback
 import logging
+import contextvars
 from importlib import reload
 from webob.static import FileApp
 from webframe.core.http.requests import Request
 from webframe.core.http.responses import Response
+from webframe.core.http import files, session
+from webframe.core.http.files import FileResponse, SendfileResponse
+from webframe.core.http.streaming import StreamingBody, ContextIterable, is_stream
 from webframe.core.route import Router, ResourceRoute
 from webframe.utils import storage
+from webframe.utils.routes import host_prefix
 from webframe.utils.errors import abort
-from webframe.utils import errors, db
-from webframe.core import app
-from threading import Semaphore
+from webframe.utils import errors, db, concurrency
+from webframe.core import app, context, timing, metrics, profiling, logs, assets
+from webframe.core.admission import AdmissionController, Overloaded
+from webframe.core.cache import PageCache
+from webframe.core.static import StaticServer
 
 def app_setup(userapp):
     """Set up global variables."""
     app.userapp = userapp
-    app.router = Router(app.userapp.routes.route.routes)
-    if app.db is not None:
-        app.db.close()
-    app.db = db.make_session(app.userapp.settings.ENGINE)
-    if WSGIApp.conn_pool is None:
-        WSGIApp.conn_pool = Semaphore(app.userapp.settings.MAX_CONNECTIONS)
+    app.router = Router(
+        app.userapp.routes.route.routes,
+        host_prefix(app.userapp.settings)
+    )
+    # Close the session left open by a previous setup.
+    context.current().close_db()
+    app.session_factory = db.make_session_factory(app.userapp.settings.ENGINE)
+    # Each request gets its own session from the pool when it first uses app.db.
+    app.db = context.ContextSession()
+    if WSGIApp.admission is None:
+        WSGIApp.admission = AdmissionController.from_settings(app.userapp.settings)
+    app.page_cache = PageCache.from_settings(app.userapp.settings, app.router.routes)
+    app.static = StaticServer.from_settings(app.userapp.settings)
+    assets.configure(app.userapp.settings)
+    files.configure(app.userapp.settings)
+    session.configure(app.userapp.settings)
+    timing.configure(app.userapp.settings)
+    metrics.configure(app.userapp.settings)
+    profiling.configure(app.userapp.settings)
+
+def app_teardown():
+    """Release the global resources created by app_setup()."""
+    context.current().close_db()
+    app.userapp.settings.ENGINE.dispose()
 
 class WSGIApp(object):
-    """The app entry point from a wsgi call."""
+    """
+    The app entry point from a wsgi call.
+
+    This should be built once at boot and then called for every request,
+    the router and DB engine are shared between requests. Each request is
+    handled in its own RequestContext (see webframe.core.context).
+    """
 
-    conn_pool = None
+    # Limits how many requests are handled at once (see core/admission.py).
+    admission = None
 
     def __init__(self, userapp):
-        app_setup(userapp)
+        # Settings app_setup() has usually done this already.
+        if app.userapp is not userapp or app.router is None:
+            app_setup(userapp)
+        self.startup()
+
+    def startup(self):
+        """Run the startup hooks and mark the app as ready."""
+        if app.ready:
+            return
+        for hook in app.startup_hooks:
+            hook(app.userapp)
+        app.ready = True
+        logging.info('App ready.')
+
+    def shutdown(self):
+        """Stop serving requests, run the shutdown hooks and release resources."""
+        if not app.ready:
+            return
+        app.ready = False
+        logging.info('Shutting down...')
+        for hook in reversed(app.shutdown_hooks):
+            try:
+                hook(app.userapp)
+            except Exception as e:
+                logging.error('Error while running shutdown hook.')
+                logging.exception(e)
+        app_teardown()
 
     def  __call__(self, environ, start_response):
         """The app entry point."""
-        WSGIApp.conn_pool.acquire()
+        if not app.ready:
+            start_response(
+                '503 Service Unavailable',
+                [('Content-type', 'text/plain'), ('Retry-After', '1')]
+            )
+            return [b'Service unavailable.']
+        ctx = context.RequestContext()
+        timing.start(ctx)
+        with ctx:
+            result = self.handle(environ, start_response)
+        if not ctx.streaming:
+            timing.collect(ctx)
+        return result
+
+    def handle(self, environ, start_response):
+        """Handle a request inside its request context."""
         logging.info('New request incoming...')
+        started = time.perf_counter()
+        request = Request(environ)
+        ctx = context.current()
+        ctx.request = request
+        # Scrapes are answered even when the server is overloaded.
+        if metrics.path is not None and request.path_info == metrics.path:
+            return metrics.response(request)(environ, start_response)
+        with timing.phase('routing'):
+            route = self.resolve(request)
+
+        cached, flight = app.page_cache.begin(request, route)
+        if cached is not None:
+            self.finished(request, route, cached, started)
+            return cached(environ, start_response)
+
+        try:
+            with timing.phase('admission'):
+                admission = WSGIApp.admission.acquire(route)
+        except Overloaded as e:
+            if flight is not None:
+                app.page_cache.finish(flight)
+            response = self.overloaded(request, e)
+            self.finished(request, route, response, started)
+            return response(environ, start_response)
+
         try:
-            request = Request(environ)
-            logging.info(
-                'New \'%s\' request for \'%s\' from \'%s\'',
-                request.method,
-                request.path,
-                request.client_addr
-            )
-            response = self.generate(request, Response(request))
-            if response.__class__ == FileApp:
-                return response(environ, start_response)
-        except Exception as e:
-            logging.exception(e)
-            traceback.print_stack()
-            # Do some wsgi hackery
-            body = ''
-            status = f'{str(500)}'
-            headers = [('Content-type', 'text/plain')]
             try:
-                body = app.userapp.settings.ERROR_HANDLERS[500](traceback.format_exc())
-                headers = [('Content-type', 'text/html')]
+                logging.info(
+                    'New \'%s\' request for \'%s\' from \'%s\'',
+                    request.method,
+                    request.path,
+                    request.client_addr
+                )
+                profiler = profiling.start(request, route)
+                try:
+                    response = self.generate(request, Response(request), route)
+                finally:
+                    if profiler is not None:
+                        profiling.finish(profiler, route)
             except Exception as e:
-                logging.error('Error while trying to get 500 error page.')
                 logging.exception(e)
-                body = 'Internal server error.'
-            start_response(status, headers)
-            return [body.encode('utf-8')]
-        finally:
-            WSGIApp.conn_pool.release()
-            app.db.close()
+                response = self.server_error(request)
+            if flight is not None:
+                app.page_cache.finish(flight, response)
+                flight = None
+            timing.set_header(response, ctx.timings)
+            if isinstance(getattr(response, 'app_iter', None), StreamingBody):
+                return self.stream(request, response, environ, start_response, admission, route, started)
+        except BaseException:
+            if flight is not None:
+                app.page_cache.finish(flight)
+            WSGIApp.admission.release(admission)
+            raise
+        WSGIApp.admission.release(admission)
+        self.finished(request, route, response, started)
         return response(environ, start_response)
 
-    def generate(self, request, response):
-        """Takes request and response objects and returns response."""
+    def stream(self, request, response, environ, start_response, admission, route, started):
+        """
+        Send a streamed response. The request is finished (DB session closed,
+        admission released) once the server closes the body.
+        """
+        ctx = context.current()
+        result = response(environ, start_response)
+
+        def finish():
+            try:
+                ctx.close_db()
+            finally:
+                WSGIApp.admission.release(admission)
+                self.finished(request, route, response, started)
+                timing.collect(ctx)
+
+        iterable = ContextIterable(result, contextvars.copy_context(), finish)
+        ctx.streaming = True
+        return iterable
+
+    def finished(self, request, route, response, started):
+        """Record a handled request in the metrics and the access log."""
+        # A FileApp only has a status once it is called.
+        status = getattr(response, 'status_code', 200)
+        metrics.record_request(route, status, time.perf_counter() - started)
+        logs.access(
+            request,
+            status,
+            getattr(response, 'content_length', None),
+            context.current().user
+        )
+
+    def server_error(self, request):
+        """The response for an unhandled exception, must be called while handling it."""
+        response = Response(request)
+        response.status = 500
+        try:
+            response.text = app.userapp.settings.ERROR_HANDLERS[500](traceback.format_exc())
+        except Exception as e:
+            logging.error('Error while trying to get 500 error page.')
+            logging.exception(e)
+            response.content_type = 'text/plain'
+            response.text = 'Internal server error.'
+        return response
+
+    def resolve(self, request):
+        """Route the request, None if it does not match a route."""
         try:
-            route = app.router.get_route(request)
+            return app.router.get_route(request)
+        except errors.HttpError:
+            return None
+
+    def overloaded(self, request, e):
+        """The response for a request which was turned away."""
+        response = Response(request)
+        self.set_error(response, errors.HttpError(503, 'Server busy, please try again.'))
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+
+    def generate(self, request, response, route=None):
+        """
+        Takes request and response objects and returns response.
+        The route is looked up if it has not been resolved already.
+        """
+        try:
+            if route is None:
+                with timing.phase('routing'):
+                    route = app.router.get_route(request)
 
             if isinstance(route, ResourceRoute):
                 logging.info('Route is resource route.')
@@ -84,9 +246,10 @@ class WSGIApp(object):
                 try:
                     rp = self.get_response(route, request, response)
                     # For file streams.
-                    if rp.__class__ == FileApp:
+                    if isinstance(rp, (FileApp, FileResponse, SendfileResponse)):
                         return rp
-                    response.text = rp
+                    self.set_body(response, rp)
+                    self.add_etag(response, route)
                     logging.info('Response fetched...')
                 except errors.DebugError as e:
                     if app.userapp.settings.DEBUG:
@@ -95,30 +258,62 @@ class WSGIApp(object):
                     else:
                         raise errors.HttpError(500, '')
         except errors.HttpError as e:
-            if e.code == 500:
-                logging.exception(e)
-            if e.response:
-                response.location = e.response.location
-            response.status = e.code
-            try:
-                response.text = app.userapp.settings.ERROR_HANDLERS[int(e.code)](e.message)
-            except (KeyError, ValueError):
-                response.text = e.message
+            self.set_error(response, e)
 
         logging.info('Status: %s', response.status)
 
         return response
 
+    def set_body(self, response, rp):
+        """Set the body from a controller's result: str, bytes or an iterator of chunks."""
+        if isinstance(rp, (bytes, bytearray)):
+            response.body = bytes(rp)
+        elif is_stream(rp):
+            response.app_iter = StreamingBody(rp, response.charset)
+        else:
+            response.text = rp
+        if response.status_code == 304:
+            # Not modified, there is no body.
+            response.content_length = None
+
+    def add_etag(self, response, route):
+        """
+        Add a strong ETag from the body for routes with 'etag' set (or all
+        routes with the ETAGS setting). webob then answers a matching
+        If-None-Match with 304.
+        """
+        params = getattr(route, 'route_params', None) or {}
+        if not params.get('etag', getattr(app.userapp.settings, 'ETAGS', False)):
+            return
+        if response.status_code != 200 or response.etag is not None:
+            return
+        if isinstance(response.app_iter, StreamingBody):
+            return
+        response.md5_etag()
+        response.conditional_response = True
+
+    def set_error(self, response, e):
+        """Set the response from a HttpError."""
+        if e.code == 500:
+            logging.exception(e)
+        if e.response:
+            response.location = e.response.location
+        response.status = e.code
+        try:
+            response.text = app.userapp.settings.ERROR_HANDLERS[int(e.code)](e.message)
+        except (KeyError, ValueError):
+            response.text = e.message
+
     def get_response(self, Route, request, response):
-        return Route.callable(request, response)
+        # Async controllers are run to completion.
+        return concurrency.resolve(Route.callable(request, response))
 
     def get_resource_response(self, response, route):
         """Serve a resource."""
-        try:
-            path = app.userapp.settings.RESOURCE_DIR + '/' + route.path
-            if not os.path.exists(path) or not os.path.isfile(path):
-                raise IOError
-            return FileApp(path)
-        except IOError:
-            logging.warning('IOError while trying to access resource.')
-            abort(404)
\ No newline at end of file
+        if response.request.method not in ('GET', 'HEAD'):
+            abort(405)
+        resource = app.static.response(response.request, route.path)
+        if resource is None:
+            logging.warning('Resource \'%s\' not found.', route.path)
+            abort(404)
+        return resource
\ No newline at end of file
@@ -2,6 +2,7 @@
 
 import sys
 import os
+import secrets
 
 args_to_get = {
     'name': {
@@ -120,20 +121,26 @@ import {%name%}.routes as routes
 """
 \"\"\"WSGI handler for starting the app.\"\"\"
 
+import atexit
 import logging
-from webframe.core.wsgi import WSGIApp, app_setup
+from webframe.core.wsgi import WSGIApp
+from webframe.middleware.compression import CompressionMiddleware
 import {%name%}
 from {%name%} import settings
 
 logging.info('Starting web app...')
 logging.info('Running setup...')
 settings.app_setup()
+# Built once, every request shares the router and DB engine.
+application = WSGIApp({%name%})
+atexit.register(application.shutdown)
+# gzip/deflate text responses (remove if a proxy compresses them instead).
+handler = CompressionMiddleware.from_settings(application, settings)
 logging.info('Setup complete.')
 logging.info('Waiting for requests :)')
 
 def app(environ, start_response):
-    wsgi_app = WSGIApp({%name%})
-    return wsgi_app(environ, start_response)
+    return handler(environ, start_response)
 """,
 
 # FILE
@@ -148,8 +155,65 @@ import {%name%}
 HOST = config('host')
 PORT = config_int('port')
 USING_SSL = config_bool('using_ssl')
-MAX_CONNECTIONS = 1
+# Number of requests handled at once.
+MAX_CONNECTIONS = 10
+# Requests waiting for a connection, and how long they wait (seconds)
+# before being turned away with a 503.
+MAX_QUEUE = 100
+QUEUE_TIMEOUT = 10
+# Extra slots and a separate queue for PRIORITY_HIGH routes (eg. health
+# checks), so they get through when the queue is full.
+HIGH_PRIORITY_SLOTS = 1
+HIGH_PRIORITY_QUEUE = 10
+
+# Production server (python project.py serve).
+# Worker processes, defaults to the number of CPUs.
+WORKERS = None
+# Recycle a worker after this many requests or megabytes of memory (0 for never).
+MAX_REQUESTS = 10000
+MAX_WORKER_RSS = 512
+
+# Time the phases of each request, SERVER_TIMING also sends them in a
+# Server-Timing header (see webframe.core.timing).
+TIMING = False
+SERVER_TIMING = False
+# Serve Prometheus metrics at this path, eg. '/metrics' (None to turn off).
+METRICS_PATH = None
+# Profile this fraction of requests, and requests with an 'X-Profile: <token>'
+# header (see webframe.core.profiling).
+PROFILE_RATE = 0
+PROFILE_TOKEN = None
+# Responses smaller than this (bytes) are not compressed, and the bytes of
+# compressed responses kept for reuse.
+COMPRESSION_MIN_SIZE = 500
+COMPRESSION_CACHE_BYTES = 16 * 1024 * 1024
+
+# Bounds of the full page cache (routes opt in with a 'cache' key).
+PAGE_CACHE_ENTRIES = 1000
+PAGE_CACHE_BYTES = 64 * 1024 * 1024
+# Add an ETag from the body of every 200 response (routes can opt in with
+# 'etag': True instead) and answer a matching If-None-Match with 304.
+ETAGS = False
+
+# Logs are rotated once they reach LOG_MAX_BYTES and the last LOG_BACKUPS
+# are kept (gzipped). LOG_SAMPLING keeps a fraction of busy levels, eg.
+# {'DEBUG': 0.01}. ACCESS_LOG logs each request to storage/logs/access.log.
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUPS = 10
+LOG_SAMPLING = {}
+ACCESS_LOG = True
 SESSION_EXPIRY = 3600
+# Seconds between purges of expired sessions by a background thread in
+# each process. 0 disables it, run `python project.py sessions:gc` instead.
+SESSION_GC_INTERVAL = 300
+# The session expiry is only written once it has moved this many seconds.
+SESSION_EXPIRY_REFRESH = 60
+# Keys signing sessions kept in cookies (SessionCookieStore). The first
+# signs, the others are still accepted, so add a new key first to rotate.
+SESSION_SECRET_KEYS = config('session_secret_keys').split(',')
+# Larger cookie sessions are kept in a server side store.
+SESSION_COOKIE_MAX_SIZE = 3800
+SESSION_COOKIE_COMPRESS = True
 
 APP_NAME = config('app_name')
 APP_LOCATION = config('app_location')
@@ -170,6 +234,25 @@ RESOURCE_URL = config('resource_url')
 RESOURCE_DIR = config('resource_dir')
 # whether the app should serve resources itself (not recommended outside of development)
 SERVE_PUBLIC = config_bool('serve_public')
+# Public files up to STATIC_MAX_FILE_SIZE bytes are kept in memory, up to
+# STATIC_CACHE_BYTES in all. Browsers may reuse them for STATIC_MAX_AGE seconds.
+STATIC_MAX_AGE = 3600
+STATIC_CACHE_BYTES = 32 * 1024 * 1024
+STATIC_MAX_FILE_SIZE = 256 * 1024
+# `python project.py assets:build` fingerprints the public files so
+# resource() links can be cached forever. Bundles concatenate files, eg.
+# {'js/site.js': ['js/vendor.js', 'js/app.js']}.
+ASSET_BUNDLES = {}
+ASSET_MINIFY = True
+# Let the front proxy send downloads and large public files: 'nginx'
+# (X-Accel-Redirect to SENDFILE_URL) or 'apache' (X-Sendfile). Only files
+# below SENDFILE_ROOT (required) are offloaded. SENDFILE_SECRET signs nginx URIs with
+# an expiry for the secure_link module.
+SENDFILE_BACKEND = None
+SENDFILE_ROOT = None
+SENDFILE_URL = '/protected'
+SENDFILE_SECRET = None
+SENDFILE_EXPIRES = 3600
 TEMPLATES = config('templates_dir')
 
 # DB data 
@@ -231,23 +314,14 @@ ERROR_HANDLERS = {
 # Post initial setup
 ################
 
-from webframe.core import wsgi
+from webframe.core import wsgi, logs
 callbacks = []
 def app_setup():
     \"\"\"Setup the app.\"\"\"
     wsgi.app_setup(APP)
     
-    # Logging
-    if not storage.folder_exists('logs'):
-        storage.make_folder('logs')
-    for handler in logging.root.handlers[:]:
-        logging.root.removeHandler(handler)
-    logging.basicConfig(
-        format='%(asctime)s %(levelname)s: %(message)s',
-        datefmt='%m/%d/%Y %I:%M:%S %p',
-        filename=storage.path('logs', 'main.log'),
-        level=logging.DEBUG if DEBUG else logging.INFO
-    )
+    # Logging, written to storage/logs on a background thread.
+    logs.setup(APP.settings)
 """,
 
 # FILE
@@ -292,6 +366,8 @@ app_location={%name%}
 
 // Storage for sessions and log files
 storage_dir=storage
+// Keys signing cookie sessions, comma separated
+session_secret_keys={%session_secret%}
 // Public resource url
 resource_url=/public
 // Resource location
@@ -348,6 +424,7 @@ def install():
 
     # Install here.
     print('Installing...')
+    args['session_secret'] = secrets.token_hex(32)
 
     current = os.path.abspath(__file__)
 
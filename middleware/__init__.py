@@ -1 +1 @@
-from . import session as session, route
\ No newline at end of file
+from . import session as session, route, compression
\ No newline at end of file
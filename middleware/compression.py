@@ -0,0 +1,356 @@
+"""
+Response compression.
+
+CompressionMiddleware wraps the WSGI app (see the generated wsgi.py) and
+compresses text responses with gzip or deflate, whichever the client
+prefers in its Accept-Encoding header. Small bodies, bodies which are
+already encoded, partial content and types which do not compress well
+(images, archives, ...) are sent as they are. HEAD requests get the
+headers the GET would.
+
+Streamed bodies are compressed chunk by chunk. Compressed copies of
+cacheable responses (those with an ETag, a Last-Modified date or a public
+Cache-Control) and static resources are kept in a byte bounded LRU so
+they are only compressed once. They are found by a hash of the body, only
+responses whose ETag is derived from the body (those of the StaticServer,
+which sets STRONG_VALIDATORS in the environ) are found by their
+validators without reading the body.
+"""
+
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Bodies smaller than this (in bytes) are not worth compressing.
+MIN_SIZE = 500
+LEVEL = 6
+# Bytes of compressed responses to keep.
+CACHE_BYTES = 16 * 1024 * 1024
+# Bodies larger than this are streamed rather than buffered and cached.
+MAX_BUFFER = 1024 * 1024
+
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/rss+xml',
+    'application/atom+xml',
+    'application/ld+json',
+    'application/manifest+json',
+    'image/svg+xml',
+)
+
+# The environ key set by apps whose ETags are derived from the response body.
+STRONG_VALIDATORS = 'webframe.strong_validators'
+
+# The wbits for each content coding.
+_WBITS = {'gzip': 31, 'deflate': 15}
+
+
+def negotiate(accept_encoding):
+    """The coding to use for an Accept-Encoding header, gzip or deflate, or None."""
+    best = None
+    best_q = 0.0
+    wildcard = 0.0
+    listed = set()
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        listed.add(coding)
+        if coding == '*':
+            wildcard = q
+        elif coding in _WBITS and (q > best_q or (q == best_q and q > 0 and coding == 'gzip')):
+            # gzip is preferred when both are equally acceptable.
+            best, best_q = coding, q
+    if best is None and wildcard > 0:
+        for coding in ('gzip', 'deflate'):
+            if coding not in listed:
+                return coding
+    return best
+
+
+class CompressedCache(object):
+    """A byte bounded LRU of compressed bodies."""
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def set(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+def _header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+def _without(headers, *names):
+    names = [n.lower() for n in names]
+    return [(k, v) for k, v in headers if k.lower() not in names]
+
+def _add_vary(headers):
+    vary = _header(headers, 'Vary')
+    if vary is None:
+        return headers + [('Vary', 'Accept-Encoding')]
+    values = [v.strip().lower() for v in vary.split(',')]
+    if '*' in values or 'accept-encoding' in values:
+        return headers
+    return _without(headers, 'Vary') + [('Vary', vary + ', Accept-Encoding')]
+
+def _weak_etag(headers):
+    """The ETag of the encoded body must differ from the identity body's."""
+    etag = _header(headers, 'ETag')
+    if etag is None or etag.startswith('W/'):
+        return headers
+    return _without(headers, 'ETag') + [('ETag', 'W/' + etag)]
+
+
+class _CompressedIter(object):
+    """Compresses a streamed body chunk by chunk."""
+
+    def __init__(self, chunks, app_iter, coding, level):
+        self.chunks = chunks
+        self.app_iter = app_iter
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS[coding])
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._done:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self._done = True
+                return self.compressor.flush()
+            if chunk:
+                # Sync flush so each chunk reaches the client as it is produced.
+                return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        raise StopIteration
+
+    def close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+class CompressionMiddleware(object):
+    """Compresses the responses of a WSGI app."""
+
+    def __init__(self, app, min_size=MIN_SIZE, level=LEVEL, cache_bytes=CACHE_BYTES):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.cache = CompressedCache(cache_bytes) if cache_bytes else None
+
+    @staticmethod
+    def from_settings(app, settings):
+        return CompressionMiddleware(
+            app,
+            getattr(settings, 'COMPRESSION_MIN_SIZE', MIN_SIZE),
+            getattr(settings, 'COMPRESSION_LEVEL', LEVEL),
+            getattr(settings, 'COMPRESSION_CACHE_BYTES', CACHE_BYTES)
+        )
+
+    def __getattr__(self, name):
+        # Eg. shutdown() of the wrapped WSGIApp.
+        return getattr(self.app, name)
+
+    def __call__(self, environ, start_response):
+        started = {}
+        written = []
+        passthrough = False
+
+        def capture(status, headers, exc_info=None):
+            if passthrough:
+                return start_response(status, headers, exc_info)
+            started['status'] = status
+            started['headers'] = headers
+            started['exc_info'] = exc_info
+            return written.append
+
+        app_iter = self.app(environ, capture)
+        chunks = None
+        if 'status' not in started:
+            # The app starts the response on its first chunk.
+            chunks = iter(app_iter)
+            first = next(chunks, None)
+            if 'status' not in started:
+                # Not started yet, leave the response to the app and the server.
+                passthrough = True
+                return _Passthrough(_prepend([first] if first is not None else [], chunks), app_iter)
+            chunks = _prepend([first] if first is not None else [], chunks)
+        if written:
+            chunks = _prepend(written, chunks if chunks is not None else iter(app_iter))
+
+        status = started['status']
+        headers = started['headers']
+        if not self._compressible(status, headers):
+            start_response(status, headers, started['exc_info'])
+            # Untouched, so the server can still use wsgi.file_wrapper.
+            if chunks is None:
+                return app_iter
+            return _Passthrough(chunks, app_iter)
+        if chunks is None:
+            chunks = iter(app_iter)
+
+        headers = _add_vary(headers)
+        coding = negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        length = _header(headers, 'Content-Length')
+        length = int(length) if length is not None and length.isdigit() else None
+        if coding is None or (length is not None and length < self.min_size):
+            start_response(status, headers, started['exc_info'])
+            return _Passthrough(chunks, app_iter)
+
+        headers = _weak_etag(_without(headers, 'Content-Length')) + [('Content-Encoding', coding)]
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            # The headers of the GET, with its length if it is cached.
+            _close(app_iter)
+            key = self._cache_key(environ, headers, coding, length)
+            body = self.cache.get(key) if key is not None else None
+            if body is not None:
+                headers = headers + [('Content-Length', str(len(body)))]
+            start_response(status, headers, started['exc_info'])
+            return []
+        if length is None or length > MAX_BUFFER:
+            start_response(status, headers, started['exc_info'])
+            return _CompressedIter(chunks, app_iter, coding, self.level)
+
+        key = self._cache_key(environ, headers, coding, length)
+        body = self.cache.get(key) if key is not None else None
+        if body is None:
+            try:
+                data = b''.join(chunks)
+            finally:
+                _close(app_iter)
+            if key is None and self._cacheable(headers):
+                key = (coding, hashlib.blake2b(data, digest_size=16).digest())
+                body = self.cache.get(key)
+            if body is None:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, _WBITS[coding])
+                body = compressor.compress(data) + compressor.flush()
+                if key is not None:
+                    self.cache.set(key, body)
+        else:
+            _close(app_iter)
+
+        start_response(status, headers + [('Content-Length', str(len(body)))], started['exc_info'])
+        return [body]
+
+    def _compressible(self, status, headers):
+        code = status[:3]
+        if code < '200' or code in ('204', '206', '304'):
+            return False
+        if _header(headers, 'Content-Encoding') not in (None, 'identity'):
+            return False
+        if _header(headers, 'Content-Range') is not None:
+            return False
+        if 'no-transform' in (_header(headers, 'Cache-Control') or ''):
+            return False
+        content_type = (_header(headers, 'Content-Type') or '').split(';')[0].strip().lower()
+        return content_type.startswith(COMPRESSIBLE_TYPES) or content_type.endswith(('+json', '+xml'))
+
+    def _cacheable(self, headers):
+        if self.cache is None:
+            return False
+        cache_control = (_header(headers, 'Cache-Control') or '').lower()
+        if 'no-store' in cache_control or 'private' in cache_control:
+            return False
+        return (
+            'public' in cache_control
+            or 'max-age' in cache_control
+            or _header(headers, 'Last-Modified') is not None
+            or _header(headers, 'ETag') is not None
+        )
+
+    def _cache_key(self, environ, headers, coding, length):
+        """
+        A key from the response's validators, so the body need not be read
+        to find it in the cache. None if the body must be hashed instead,
+        which is unless the app derived the ETag from the body and the
+        response varies on nothing but Accept-Encoding.
+        """
+        if not environ.get(STRONG_VALIDATORS) or not self._cacheable(headers):
+            return None
+        vary = _header(headers, 'Vary') or ''
+        if any(v.strip().lower() not in ('', 'accept-encoding') for v in vary.split(',')):
+            return None
+        etag = _header(headers, 'ETag')
+        modified = _header(headers, 'Last-Modified')
+        if etag is None:
+            return None
+        return (
+            coding,
+            environ.get('PATH_INFO', ''),
+            environ.get('QUERY_STRING', ''),
+            etag,
+            modified,
+            length,
+            _header(headers, 'Content-Type'),
+        )
+
+
+def _prepend(first, chunks):
+    yield from first
+    yield from chunks
+
+def _close(app_iter):
+    close = getattr(app_iter, 'close', None)
+    if close is not None:
+        close()
+
+
+class _Passthrough(object):
+    """The app's body as it is, closing the app's iterable when closed."""
+
+    def __init__(self, chunks, app_iter):
+        self.chunks = chunks
+        self.app_iter = app_iter
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks)
+
+    def close(self):
+        _close(self.app_iter)
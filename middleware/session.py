@@ -4,13 +4,17 @@ Should be seperated into small operations so user can pick and choose
 how to use it.
 """
 
-from webframe.core.http.session import Session
+from webframe.core.http.session import LazySession
 from webframe.utils import errors
+from webframe.core import timing
 
 
 def fetch_or_create_session(request, response):
-    """Create a new session of get the session if it exists."""
-    request.session = Session(request)
+    """
+    Give the request its session. It is only read (or created) when it is
+    first used, so requests which never use it pay nothing.
+    """
+    request.session = LazySession(request)
 
 def set_session_token_on_response(request, response):
     """Set the session token."""
@@ -33,5 +37,6 @@ def session_commit(request, response):
     Commit the session at the end of the request.
     This is designed to be run at GLOBAL_AFTER_MIDDLEWARE.
     """
-    request.session.commit()
+    with timing.phase('session_commit'):
+        request.session.commit()
 
@@ -35,6 +35,7 @@ class Model():
         """Save the model."""
         self.stage()
         Model.save_all()
+        self._invalidate_pages()
 
         return self
 
@@ -42,6 +43,12 @@ class Model():
         """Delete the model from the database."""
         app.db.delete(self)
         Model.save_all()
+        self._invalidate_pages()
+
+    def _invalidate_pages(self):
+        """Clear the cached pages which depend on this model."""
+        if app.page_cache is not None:
+            app.page_cache.invalidate_model(type(self))
 
     def fresh(self):
         """Get a fresh object from the db."""
@@ -0,0 +1,119 @@
+"""
+An in-process client for testing ASGI apps.
+
+Runs the app directly without a server, eg.
+    client = ASGIClient(ASGIApp(myapp))
+    response = client.get('/users', get={'page': 2})
+    response.status, response.headers, response.text
+
+lifespan() sends the startup and shutdown events a server would, eg.
+    async with client.lifespan():
+        response = await client.arequest('GET', '/users')
+"""
+
+import json
+import asyncio
+import contextlib
+from urllib.parse import urlencode
+
+
+class ASGIResponse:
+    """The status, headers and body sent by the app."""
+
+    def __init__(self):
+        self.status = None
+        self.headers = {}
+        self.body = b''
+
+    @property
+    def text(self):
+        return self.body.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class ASGIClient:
+
+    def __init__(self, app, host='localhost', port=80):
+        self.app = app
+        self.host = host
+        self.port = port
+
+    @contextlib.asynccontextmanager
+    async def lifespan(self):
+        """Sends lifespan.startup on entry and lifespan.shutdown on exit."""
+        events = asyncio.Queue()
+        sent = asyncio.Queue()
+        scope = {'type': 'lifespan', 'asgi': {'version': '3.0'}}
+        task = asyncio.ensure_future(self.app(scope, events.get, sent.put))
+        await events.put({'type': 'lifespan.startup'})
+        message = await sent.get()
+        if message['type'] != 'lifespan.startup.complete':
+            await task
+            raise RuntimeError('Startup failed: ' + message.get('message', ''))
+        try:
+            yield self
+        finally:
+            await events.put({'type': 'lifespan.shutdown'})
+            await sent.get()
+            await task
+
+    def get(self, path, get=None, headers=None):
+        return self.request('GET', path, get=get, headers=headers)
+
+    def post(self, path, data=None, headers=None, json_data=None):
+        headers = dict(headers or {})
+        body = b''
+        if json_data is not None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(json_data).encode('utf-8')
+        elif data is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            body = urlencode(data).encode('utf-8')
+        return self.request('POST', path, body=body, headers=headers)
+
+    def request(self, method, path, get=None, body=b'', headers=None):
+        """Make a request and wait for the response."""
+        return asyncio.run(self.arequest(method, path, get, body, headers))
+
+    async def arequest(self, method, path, get=None, body=b'', headers=None):
+        """Make a request from a running event loop, eg. to send many at once."""
+        headers = {'Host': f'{self.host}:{self.port}', **(headers or {})}
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method.upper(),
+            'scheme': 'http',
+            'path': path,
+            'root_path': '',
+            'query_string': urlencode(get or {}).encode('latin-1'),
+            'headers': [
+                (name.lower().encode('latin-1'), str(value).encode('latin-1'))
+                for name, value in headers.items()
+            ],
+            'client': ('127.0.0.1', 123456),
+            'server': (self.host, self.port),
+        }
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        response = ASGIResponse()
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            # The request has been read, wait as if the client is still connected.
+            await asyncio.Future()
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response.status = message['status']
+                response.headers = {
+                    name.decode('latin-1'): value.decode('latin-1')
+                    for name, value in message['headers']
+                }
+            elif message['type'] == 'http.response.body':
+                response.body += message.get('body', b'')
+
+        await self.app(scope, receive, send)
+        return response
@@ -0,0 +1,79 @@
+"""
+Tests of the ASGI entry point, run with
+`python -m unittest webframe.tests.test_asgi`.
+"""
+
+import types
+import asyncio
+import tempfile
+import unittest
+from sqlalchemy import create_engine
+from webframe.controller import Controller
+from webframe.core import app
+from webframe.core.asgi import ASGIApp
+from webframe.core.wsgi import WSGIApp
+from webframe.tests.asgiclient import ASGIClient
+
+
+class AsyncController(Controller):
+
+    async def view(self):
+        await asyncio.sleep(0)
+        return 'async ' + str(self.request.url_param('id'))
+
+
+def make_userapp(routes):
+    """A user app with the least settings the framework needs."""
+    storage = tempfile.mkdtemp()
+    settings = types.SimpleNamespace(
+        DEBUG=False,
+        HOST='localhost',
+        PORT=80,
+        USING_SSL=False,
+        MAX_CONNECTIONS=10,
+        SESSION_EXPIRY=3600,
+        STORAGE_DIR=storage,
+        RESOURCE_URL='/public',
+        RESOURCE_DIR=storage,
+        SERVE_PUBLIC=False,
+        ENGINE=create_engine('sqlite://'),
+        GLOBAL_MIDDLEWARE=[],
+        GLOBAL_AFTER_MIDDLEWARE=[],
+        ERROR_HANDLERS={},
+    )
+    route = types.SimpleNamespace(routes=routes)
+    return types.SimpleNamespace(settings=settings, routes=types.SimpleNamespace(route=route))
+
+
+class ASGIAppTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shutdowns = []
+        app.on_shutdown(self.shutdowns.append)
+        userapp = make_userapp([
+            {'path': '/async/{id:int}', 'command': AsyncController(), 'name': 'async'},
+        ])
+        self.client = ASGIClient(ASGIApp(userapp))
+
+    def tearDown(self):
+        app.shutdown_hooks.remove(self.shutdowns.append)
+        app.ready = False
+        app.userapp = None
+        app.router = None
+        WSGIApp.admission = None
+
+    def test_lifespan_and_request(self):
+        async def run():
+            async with self.client.lifespan():
+                response = await self.client.arequest('GET', '/async/3')
+            after = await self.client.arequest('GET', '/async/3')
+            return response, after
+
+        response, after = asyncio.run(run())
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.text, 'async 3')
+        self.assertEqual(len(self.shutdowns), 1)
+        # Not served once shut down.
+        self.assertEqual(after.status, 503)
+        self.assertEqual(after.headers.get('retry-after'), '1')
+
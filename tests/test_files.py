@@ -0,0 +1,82 @@
+"""
+Tests of file responses sent by the pre-fork server's workers, run with
+`python -m unittest webframe.tests.test_files`.
+"""
+
+import os
+import socket
+import tempfile
+import threading
+import unittest
+import http.client
+from unittest import mock
+from webframe.core.http.files import FileResponse
+from webframe.core.http.requests import Request
+from webframe.core.server import _WorkerServer
+
+SIZE = 300 * 1024
+
+
+def file_app(path):
+    def application(environ, start_response):
+        return FileResponse(Request(environ), path)(environ, start_response)
+    return application
+
+
+class FileResponseServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(SIZE)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+
+        # As the master does, a listening socket on an ephemeral port.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(8)
+        self.port = listener.getsockname()[1]
+        self.server = _WorkerServer(listener)
+        self.server.set_app(file_app(self.path))
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        os.remove(self.path)
+
+    def get(self, headers=None):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        try:
+            connection.request('GET', '/file', headers=headers or {})
+            response = connection.getresponse()
+            return response, response.read()
+        finally:
+            connection.close()
+
+    def test_whole_file(self):
+        with mock.patch.object(socket.socket, 'sendfile', autospec=True, side_effect=socket.socket.sendfile) as sendfile:
+            response, body = self.get()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Length'), str(SIZE))
+        self.assertEqual(body, self.data)
+        # Sent by the kernel rather than read through Python.
+        self.assertEqual(sendfile.call_count, 1)
+
+    def test_range(self):
+        start, end = 1000, 200 * 1024
+        with mock.patch.object(socket.socket, 'sendfile', autospec=True, side_effect=socket.socket.sendfile) as sendfile:
+            response, body = self.get({'Range': f'bytes={start}-{end - 1}'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.getheader('Content-Length'), str(end - start))
+        self.assertEqual(response.getheader('Content-Range'), f'bytes {start}-{end - 1}/{SIZE}')
+        self.assertEqual(body, self.data[start:end])
+        self.assertEqual(sendfile.call_args[0][2:], (start, end - start))
+
+    def test_suffix_range(self):
+        response, body = self.get({'Range': 'bytes=-100'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.getheader('Content-Length'), '100')
+        self.assertEqual(body, self.data[-100:])
@@ -44,6 +44,7 @@ class TestCase(TestUtils, metaclass=_Watcher):
 
     def teardown(self):
         SessionMemoryStore.sessions = {}
+        SessionMemoryStore.expiries = []
         app.db.rollback()
         app.db.close()
 
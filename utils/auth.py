@@ -1,7 +1,7 @@
 """Defines some generic auth functionality for login/logout."""
 
 import bcrypt
-from webframe.core import app
+from webframe.core import app, context
 
 def auth(request):
     return Auth(request, app.userapp.settings.AUTH_MODEL)
@@ -11,12 +11,21 @@ def user():
     Get the authorised user.
     This requires that Auth.authuser has been set.
     """
-    return Auth.authuser
+    return context.current().user
 
-class Auth():
-    """A simple wrapper around the session for authentication of users."""
+class _AuthMeta(type):
+    """Stores Auth.authuser on the current request context, not the class."""
+
+    @property
+    def authuser(cls):
+        return context.current().user
 
-    authuser = None
+    @authuser.setter
+    def authuser(cls, user):
+        context.current().user = user
+
+class Auth(metaclass=_AuthMeta):
+    """A simple wrapper around the session for authentication of users."""
 
     def __init__(self, request, usermodel):
         self.request = request
@@ -0,0 +1,38 @@
+"""Utilities for mixing sync and async code."""
+
+import asyncio
+import inspect
+import functools
+import contextvars
+
+
+def is_async_callable(obj):
+    """True if calling obj returns an awaitable (async functions and controllers)."""
+    if inspect.iscoroutinefunction(obj):
+        return True
+    is_async = getattr(obj, 'is_async', None)
+    if callable(is_async):
+        return is_async()
+    return inspect.iscoroutinefunction(getattr(obj, '__call__', None))
+
+async def run_sync(func, *args, **kwargs):
+    """
+    Run a blocking function in the event loop's thread pool.
+    The function sees the context (eg. the request context) of the caller.
+    """
+    loop = asyncio.get_event_loop()
+    ctx = contextvars.copy_context()
+    call = functools.partial(ctx.run, func, *args, **kwargs)
+    return await loop.run_in_executor(None, call)
+
+def run_coroutine(awaitable):
+    """Run an awaitable to completion from sync code with no running event loop."""
+    async def wrapper():
+        return await awaitable
+    return asyncio.run(wrapper())
+
+def resolve(result):
+    """Returns the result, running it to completion first if it is awaitable."""
+    if inspect.isawaitable(result):
+        return run_coroutine(result)
+    return result
@@ -5,6 +5,10 @@ from sqlalchemy.orm import sessionmaker
 def make_session(engine):
     return sessionmaker(engine)();
 
+def make_session_factory(engine):
+    """A factory for sessions bound to the engine and its connection pool."""
+    return sessionmaker(engine)
+
 def get_connection_string(_type, engine, user, password, ip, port, name):
     """Get the connection string."""
     return '%s+%s://%s:%s@%s:%i/%s?charset=utf8mb4' % (